@@ -3,9 +3,24 @@ import aiohttp
 import traceback
 import os
 
-from bs4 import BeautifulSoup
-from support import AsyncTaskRuner, load_json_data, BaseTask, exist_or_create_path, save_json_data
-from shapely.geometry import shape, Point
+from support import (
+    load_json_data, BaseTask, RetryTask, exist_or_create_path, save_json_data, Journal, JournalSet, JournalDict, JournalList,
+)
+from fetch import Fetcher, encoded_name, retry_after, save_response, transient_error
+from geo_index import PolygonIndex
+from id_store import IdSet, IdStatusDict, is_id, load_ids, save_ids
+from osm_html import trace_details, trace_links
+from persistence import wait_saved
+from pipeline import Pipeline
+from state_store import StateStore
+
+# Адрес сайта, для тестов и замеров можно подменить локальным сервером (см. benchmark.py).
+OSM_URL = os.getenv("OSM_URL", "https://www.openstreetmap.org")
+
+# Ограничение частоты запросов (в секунду) и скорости загрузки (байт в секунду) к
+# openstreetmap.org, общее для всех стадий. Не задано - без ограничения.
+OSM_REQUESTS_PER_SECOND = float(os.getenv("OSM_RPS", 0)) or None
+OSM_BYTES_PER_SECOND = float(os.getenv("OSM_BPS", 0)) or None
 
 
 class CheckNewPages(BaseTask):
@@ -13,27 +28,44 @@ class CheckNewPages(BaseTask):
     Скачивает новые ссылки на GPS треки пользователей с сайта
     https://www.openstreetmap.org/
     """
+    use_session = True
+    requests_per_second = OSM_REQUESTS_PER_SECOND
+    bytes_per_second = OSM_BYTES_PER_SECOND
+    # Валидаторы страниц меняются в task - в процессах-исполнителях их нужно вернуть в основной процесс.
+    shared_state = ("_continue", "_results_len", "_count_good", "fetcher.validators")
 
-    def __init__(self, append, *args, **kwargs):
+    def __init__(self, *args, store: StateStore = None, **kwargs):
         """
         self.results - новые ссылки (self.name - передаётся в kwargs) найденные во время поиска.
         В идеале этот файл будет отсутствовать при шатном завершении скрипта. Всё сохранит в
-        файл self.name_full_list ("page_links.json").
+        файл self.name_full_list ("page_links.json"). В ходе работы новые ссылки дописываются
+        в журнал "new_page_list.jsonl", после аварии он подхватывается при следующем запуске.
         self.results_for_search - ранее загруженные ссылки. Файл self.name_full_list
         ("page_links.json")
+        store - хранилище состояния (StateStore), если передано - вместо json файлов
+        всё хранится в нём и ранее загруженные ссылки не поднимаются в память.
         Забил на переачу имени для сохранения результатов, вписал по хардкору.
         """
         self.name = "new_page_list.json"
         self.name_full_list = "page_links.json"
-        self.results_for_search = set(load_json_data(self.name_full_list, [])) | set(load_json_data(self.name, []))
-        self.results = set()
+        self.store = store
+        if store is None:
+            journal = Journal("new_page_list.jsonl")
+            self.results_for_search = (
+                set(load_json_data(self.name_full_list, [])) | set(load_json_data(self.name, [])) | journal.keys()
+            )
+        else:
+            journal = store.journal("page_links")
+            self.results_for_search = store.page_links
+        self.results = JournalSet(journal)
         self._results_len = len(self.results)
+        # Валидаторы страниц: неизменившиеся с прошлого запуска страницы не скачиваются повторно.
+        self.fetcher = Fetcher("page_validators.json")
 
         # Пока True - данные для обработки есть.
         # Как только станет False - больше обрабатывать нечего.
         self._continue = True
 
-        self.mail_to = append  # Метод для добавления полученного результата в другой обработчик.
         self._count_good = 0  # Для вывода логов
         super().__init__(*args, **kwargs)
 
@@ -49,38 +81,43 @@ class CheckNewPages(BaseTask):
         Разбирает её на составляющие и выгружает новые ссылки типа:
         https://www.openstreetmap.org/user/dragonpilot/traces/7706595
         """
-        url = "https://www.openstreetmap.org/traces/page/%s"
+        url = OSM_URL + "/traces/page/%s"
         try:
             timeout = aiohttp.ClientTimeout(total=600)
-            async with aiohttp.ClientSession(
-                    connector=aiohttp.TCPConnector(ssl=False),
-                    raise_for_status=True,
-            ) as session:
-                async with session.get(url % data, timeout=timeout) as resp:
-                    if resp.status != 200:
-                        return
-
-                    # Блок отвечающий за поиск и добавление новых ссылок со страницы.
-                    soup = BeautifulSoup(await resp.content.read(), "html.parser")
-                    a_links = soup.find_all('a', href=True)
-                    for a in a_links:
-                        if a.text.endswith(".gpx") and a["href"] not in self.results_for_search:
-                            self.results.add(a["href"])
-                            self.mail_to(a["href"])
-                            self._count_good += 1
-
-                    # Блок отвечающий за проверку на факт добавления новых ссылок.
-                    new_len = len(self.results)
-                    if self._results_len == new_len:
-                        self._continue = False
-                        print("!!! STOP ITERATIONS !!!")
-                    else:
-                        self._results_len = new_len
+            async with self.fetcher.get(self.session, url % data, timeout=timeout) as resp:
+                if resp.status == 304:
+                    # Страница не изменилась - новых треков с прошлого запуска не появилось.
+                    self._continue = False
+                    print("!!! STOP ITERATIONS !!!")
+                    return
+                if resp.status != 200:
+                    return
+
+                # Блок отвечающий за поиск и добавление новых ссылок со страницы.
+                for href in trace_links(await resp.content.read()):
+                    if not is_id(href.split("/")[-1]):
+                        print(f"Пропущена ссылка на трек с не числовым id: {href}")
+                        continue
+                    if href not in self.results_for_search:
+                        self.results.add(href)
+                        await self.emit(href)
+                        self._count_good += 1
+
+                # Блок отвечающий за проверку на факт добавления новых ссылок.
+                new_len = len(self.results)
+                if self._results_len == new_len:
+                    self._continue = False
+                    print("!!! STOP ITERATIONS !!!")
+                else:
+                    self._results_len = new_len
         except KeyboardInterrupt:
             self._continue = False
         except Exception as exc:
+            if transient_error(exc):
+                raise RetryTask(str(exc), delay=retry_after(getattr(exc, "headers", None))) from exc
             print(exc)
             traceback.print_exc()
+            self.error(exc)
 
     def data_generator(self):
         """
@@ -95,9 +132,13 @@ class CheckNewPages(BaseTask):
 
     def save(self,  name: str = None, data=None):
         """
-        Сохраняет полученные результаты из self.results в self.name файл.
+        Периодическое сохранение (без параметров) дописывает новые ссылки в журнал.
         Позволяет так же сохранить произвольные данные в произавольный файл.
         """
+        if name is None and data is None:
+            super().save()
+            self.fetcher.save()
+            return
         if name is None:
             name = self.name
         if data is None:
@@ -111,8 +152,12 @@ class CheckNewPages(BaseTask):
             Удалил временный файл.
             Распечатал результат работы.
         """
-        self.save(self.name_full_list, self.results | self.results_for_search)
-        os.path.exists(self.name) and os.remove(self.name)
+        if self.store is None:
+            self.save(self.name_full_list, self.results | self.results_for_search)
+            # Промежуточные файлы удаляются только когда полный снимок уже на диске.
+            wait_saved()
+            os.path.exists(self.name) and os.remove(self.name)
+        self.results.journal.remove()
         print(f"Добавлено {self._results_len} новых записей. Всего: {len(self.results)}.")
 
 
@@ -123,7 +168,8 @@ class CheckNewLinks(BaseTask):
 
     self._links_for_search - исходный набор ссылок для проверки координат.
     Ищу те что принадлежат РФ.
-    self._results_for_search - ранее обработанные ссылки.
+    self._results_for_search - ранее обработанные ссылки (id -> статус, компактный
+    IdStatusDict, см. id_store).
     self.results - новые проверенные ссылки.
         <0 - ошибка, необходимо повторить попытку (число - это количество попыток).
         0 - не РФ, можно забить на страницу.
@@ -132,22 +178,38 @@ class CheckNewLinks(BaseTask):
     self._errors_links - список не правильных ссылок - id на странице не
     совпадает с id в ссылке. В идеале таковых быть не должно.
     """
+    use_session = True
+    requests_per_second = OSM_REQUESTS_PER_SECOND
+    bytes_per_second = OSM_BYTES_PER_SECOND
+    channel_size = 1000
+    shared_state = ("_errors_links", "_continue", "_count_good")
 
-    def __init__(self, append, *args, **kwargs):
+    def __init__(self, *args, store: StateStore = None, **kwargs):
         """
         Забил на переачу имени для сохранения результатов, вписал по хардкору.
+        store - хранилище состояния (StateStore): ссылки на проверку читаются из него
+        потоком сразу с отбором по статусу, история в память не загружается.
         """
         self.name = "new_rus_links.json"
         self.name_full_dict = "rus_links.json"
         self.name_input_data = "page_links.json"
         self.name_errors = "error_links.json"
-        self._links_for_search = load_json_data(self.name_input_data, [])
-        self._results_for_search = load_json_data(self.name_full_dict, {}) | load_json_data(self.name, {})
-        self.results = {}
+        self.store = store
+        if store is None:
+            self._links_for_search = load_json_data(self.name_input_data, [])
+            journal = Journal("new_rus_links.jsonl")
+            self._results_for_search = load_ids(self.name_full_dict, IdStatusDict)
+            self._results_for_search.update(load_json_data(self.name, {}))
+            self._results_for_search.update(journal.items())
+            self._errors_links = load_json_data(self.name_errors, [])
+        else:
+            self._links_for_search = store.pending_links()
+            journal = store.journal("links")
+            self._results_for_search = {}
+            self._errors_links = JournalList(store.journal("errors", kind="links"))
+        self.results = JournalDict(journal)
         russian_duration_json = load_json_data("russia.duration.json", {})
-        self._russian_duration_polygon = shape(russian_duration_json['geometry'])
-        self._errors_links = load_json_data(self.name_errors, [])
-        self.mail_to = append
+        self._russian_duration_polygon = PolygonIndex.from_geojson(russian_duration_json)
         self._count_good = 0
         self._continue = True
         super().__init__(*args, **kwargs)
@@ -160,63 +222,61 @@ class CheckNewLinks(BaseTask):
 
     async def task(self, data: str):
         def decrement():
-            self.results[data_id] = self.results.get(data_id, 0) - 1
+            self.results.increment(data_id, -1)
 
-        url = "https://www.openstreetmap.org%s"
+        url = OSM_URL + "%s"
         data_id = data.split("/")[-1]
         try:
             timeout = aiohttp.ClientTimeout(total=600)
-            async with aiohttp.ClientSession(
-                    connector=aiohttp.TCPConnector(ssl=False),
-                    raise_for_status=True,
-            ) as session:
-                async with session.get(url % data, timeout=timeout) as resp:
-                    if resp.status != 200:
-                        return
-                    soup = BeautifulSoup(await resp.content.read(), "html.parser")
-                    table = soup.find("table")  # Выбор таблицы на странице
-                    if not table:
-                        decrement()
-                        return
-                    # Блок проверки и получения ссылки
-                    url_link = table.find("a", href=True)
-                    if not url_link:
-                        decrement()
-                        return
-                    if url_link["href"] != f"/trace/{data_id}/data":
-                        decrement()
-                        self._errors_links.append((data, url_link["href"]))
-                        return
-
-                    # Блок получения координат
-                    lat = table.find("span", {"class": "latitude"})
-                    if not lat:
-                        decrement()
-                        return
-                    lng = table.find("span", {"class": "longitude"})
-                    if not lng:
-                        decrement()
-                        return
-                    lat = float(lat.text.replace(",", "."))
-                    lng = float(lng.text.replace(",", "."))
-
-                    # Блок проверки на вхождение в РФ
-                    # point = Point(lat, lng)
-                    point = Point(lng, lat)
-                    if self._russian_duration_polygon.contains(point):
-                        self.results[data_id] = 1
-                        self.mail_to(data_id)
-                        self._count_good += 1
-                    else:
-                        self.results[data_id] = 0
+            async with self.session.get(url % data, timeout=timeout) as resp:
+                if resp.status != 200:
+                    return
+                # Ссылка на файл и координаты из таблицы на странице
+                details = trace_details(await resp.content.read())
+                if not details:
+                    decrement()
                     return
+                url_link, lat, lng = details
+                # Блок проверки ссылки
+                if url_link is None:
+                    decrement()
+                    return
+                if url_link != f"/trace/{data_id}/data":
+                    decrement()
+                    self._errors_links.append((data, url_link))
+                    return
+
+                # Блок проверки координат
+                if lat is None or lng is None:
+                    decrement()
+                    return
+                lat = float(lat.replace(",", "."))
+                lng = float(lng.replace(",", "."))
+
+                # Блок проверки на вхождение в РФ
+                if self._russian_duration_polygon.contains(lng, lat):
+                    self.results[data_id] = 1
+                    await self.emit(data_id)
+                    self._count_good += 1
+                else:
+                    self.results[data_id] = 0
+                return
         except KeyboardInterrupt:
             self._continue = False
         except Exception as exc:
+            if transient_error(exc):
+                raise RetryTask(str(exc), delay=retry_after(getattr(exc, "headers", None))) from exc
             print(exc)
             traceback.print_exc()
+            self.error(exc)
         decrement()
 
+    def dead_letter(self, data: str, exc: Exception):
+        """Страница так и не загрузилась - ошибка засчитывается, ссылка будет проверена при следующем запуске."""
+        super().dead_letter(data, exc)
+        data_id = data.split("/")[-1]
+        self.results.increment(data_id, -1)
+
     def data_generator(self):
         """Генератор: Перебирает все ссылки которые сохранил CheckNewPages
         и проверяю их статус в self._links_for_search. Если статуса нет или
@@ -226,12 +286,18 @@ class CheckNewLinks(BaseTask):
             if not self._continue:
                 return
             link_id = link.split("/")[-1]
+            if not is_id(link_id):
+                # Такие ссылки могли остаться в page_links.json от прежних версий.
+                continue
             if -10 <= self._results_for_search.get(link_id, -2) < 0:
                 yield link
 
     def save(self, name: str = None, data=None):
         super().save(name, data)
-        save_json_data(self.name_errors, self._errors_links)
+        if self.store is None:
+            save_json_data(self.name_errors, self._errors_links)
+        else:
+            self._errors_links.journal.flush()
 
     def exit(self):
         """
@@ -240,12 +306,20 @@ class CheckNewLinks(BaseTask):
             Удалил временный файл.
             Распечатал результат работы.
         """
-        # Новый словарь перепишет значения в старом.
-        all_recs = self._results_for_search | self.results
-        self.save(self.name_full_dict, all_recs)
-        os.path.exists(self.name) and os.remove(self.name)
+        if self.store is None:
+            # Новый словарь перепишет значения в старом.
+            all_recs = self._results_for_search
+            all_recs.update(self.results)
+            save_ids(self.name_full_dict, all_recs)
+            wait_saved()
+            os.path.exists(self.name) and os.remove(self.name)
+            total = len(all_recs)
+        else:
+            self.save()
+            total = len(self.store.links)
+        self.results.journal.remove()
         print(f"Проверено: {len(self.results)} записей.")
-        print(f"Всего: {len(all_recs)}.")
+        print(f"Всего: {total}.")
         print(f"Найдено новых треков: {len([value for value in self.results.values() if value == 1])}.")
 
 
@@ -256,24 +330,45 @@ class DownloadGpxFile(BaseTask):
     Названия файлов захардкодил.
 
     self._gpx_to_download - список всех файлов на закачивание.
-    self._results_for_search - все ранее загруженные файлы.
+    self._results_for_search - все ранее загруженные файлы (компактный IdSet, см. id_store).
     self.results - список новых файлов которые были загружены во время текущей сессии.
     self._errors_links - список файлов с которыми возникли ошибки
     """
-    def __init__(self, *args, **kwargs):
+    use_session = True
+    requests_per_second = OSM_REQUESTS_PER_SECOND
+    bytes_per_second = OSM_BYTES_PER_SECOND
+    channel_size = 1000
+    shared_state = ("_errors_links", "_continue", "_count_good")
+    # Сжатые сервером файлы сохраняются как есть (.gz), их распакует UploadGpxFile.
+    session_options = {"auto_decompress": False}
+
+    def __init__(self, *args, store: StateStore = None, **kwargs):
         """
         Забил на переачу имени для сохранения результатов, вписал по хардкору.
+        store - хранилище состояния (StateStore): id на загрузку читаются из него потоком.
         """
         self.name = "new_gpx_id.json"
         self.name_full_set = "gpx_id.json"
         self.name_input_data = "rus_links.json"
         self.name_errors = "error_gpx.json"
         exist_or_create_path("output")
-        self._gpx_to_download = [key for key, value in load_json_data(self.name_input_data, {}).items() if value == 1]
-        self._results_for_search = set(load_json_data(self.name_full_set, [])) | set(load_json_data(self.name, []))
-        self.results = set()
-        self._errors_links = load_json_data(self.name_errors, [])
+        self.store = store
+        if store is None:
+            self._gpx_to_download = load_ids(self.name_input_data, IdStatusDict).select(1)
+            journal = Journal("new_gpx_id.jsonl")
+            self._results_for_search = load_ids(self.name_full_set, IdSet)
+            self._results_for_search.update(load_json_data(self.name, []))
+            self._results_for_search.update(journal.keys())
+            self._errors_links = load_json_data(self.name_errors, [])
+        else:
+            self._gpx_to_download = store.pending_downloads()
+            journal = store.journal("downloaded")
+            self._results_for_search = store.downloaded
+            self._errors_links = JournalList(store.journal("errors", kind="gpx"))
+        self.results = JournalSet(journal)
         self._count_good = 0
+        # Недокачанные файлы остаются в output/.part и при повторе догружаются с места обрыва.
+        self.fetcher = Fetcher()
         super().__init__(*args, **kwargs)
         self._continue = True
 
@@ -284,29 +379,35 @@ class DownloadGpxFile(BaseTask):
             self._count_good = 0
 
     async def task(self, data: str):
-        """Выполняет загрузку файла."""
-        url = "https://www.openstreetmap.org/trace/%s/data"
+        """Загружает файл потоком сразу на диск, после обрыва - догружает остаток (см. fetch)."""
+        url = OSM_URL + "/trace/%s/data"
         try:
             timeout = aiohttp.ClientTimeout(total=600)
-            async with aiohttp.ClientSession(
-                    connector=aiohttp.TCPConnector(ssl=False),
-                    raise_for_status=True,
-            ) as session:
-                async with session.get(url % data, timeout=timeout) as resp:
-                    if resp.status != 200:
-                        return
-                    content = await resp.content.read()
-                    filename = resp.content_disposition.filename
-                    with open(f"output/{filename}", "wb") as file:
-                        file.write(content)
-                    self.results.add(data)
-                    self._count_good += 1
+            # Сжатие - только gzip, такие файлы умеет читать UploadGpxFile.
+            headers = {"Accept-Encoding": "gzip"}
+            part = f"output/.part/{data}.part"
+            async with self.fetcher.get(self.session, url % data, part=part, timeout=timeout, headers=headers) as resp:
+                if resp.status not in (200, 206):
                     return
+                disposition = resp.content_disposition
+                filename = disposition and disposition.filename or f"{data}.gpx"
+                await save_response(resp, f"output/{encoded_name(filename, resp)}", part=part)
+                self.results.add(data)
+                self._count_good += 1
+                return
         except KeyboardInterrupt:
             self._continue = False
         except Exception as exc:
+            if transient_error(exc):
+                # Загруженная часть файла осталась в output/.part - повтор догрузит остаток.
+                raise RetryTask(str(exc), delay=retry_after(getattr(exc, "headers", None))) from exc
             print(exc)
             traceback.print_exc()
+            self.error(exc)
+        self._errors_links.append(data)
+
+    def dead_letter(self, data: str, exc: Exception):
+        super().dead_letter(data, exc)
         self._errors_links.append(data)
 
     def data_generator(self):
@@ -320,16 +421,22 @@ class DownloadGpxFile(BaseTask):
 
     def save(self, name: str = None, data=None):
         """
-        Сохраняет полученные результаты из self.results в self.name файл.
+        Периодическое сохранение (без параметров) дописывает новые id в журнал.
         Сохраняет ошибки из self._errors_links в self.name_errors файл.
         Позволяет так же сохранимть произвольные данные в произвольныфй файл.
         """
-        if name is None:
-            name = self.name
-        if data is None:
-            data = self.results
-        save_json_data(name, list(data))
-        save_json_data(self.name_errors, self._errors_links)
+        if name is None and data is None:
+            super().save()
+        else:
+            if name is None:
+                name = self.name
+            if data is None:
+                data = self.results
+            save_json_data(name, list(data))
+        if self.store is None:
+            save_json_data(self.name_errors, self._errors_links)
+        else:
+            self._errors_links.journal.flush()
 
     def exit(self):
         """
@@ -338,19 +445,56 @@ class DownloadGpxFile(BaseTask):
             Удалил временный файл.
             Распечатал результат работы.
         """
-        all_recs = self._results_for_search | self.results
-        self.save(self.name_full_set, all_recs)
-        os.path.exists(self.name) and os.remove(self.name)
+        if self.store is None:
+            all_recs = self._results_for_search
+            all_recs.update(self.results)
+            save_ids(self.name_full_set, all_recs)
+            wait_saved()
+            os.path.exists(self.name) and os.remove(self.name)
+            total = len(all_recs)
+        else:
+            self.save()
+            total = len(self.store.downloaded)
+        self.results.journal.remove()
         print(f"Загружено: {len(self.results)} файлов.")
-        print(f"Всего: {len(all_recs)}.")
-
-
-load_gpx = DownloadGpxFile()
-chk_links = CheckNewLinks(append=load_gpx.append)  # Из метода CheckNewLinks будет вызываться метод load_gpx.append
-chk_page = CheckNewPages(append=chk_links.append)  # Из метода CheckNewPages будет вызываться метод chk_links.append
-
-tasks = [chk_page, chk_links, load_gpx]
+        print(f"Всего: {total}.")
+
+
+def import_json_state(store: StateStore):
+    """Переносит в только что созданное хранилище состояние из json файлов прошлых запусков."""
+    store.import_records(
+        "page_links",
+        set(load_json_data("page_links.json", [])) | set(load_json_data("new_page_list.json", []))
+        | Journal("new_page_list.jsonl").keys()
+    )
+    store.import_records(
+        "links",
+        load_json_data("rus_links.json", {}) | load_json_data("new_rus_links.json", {})
+        | Journal("new_rus_links.jsonl").items()
+    )
+    store.import_records(
+        "downloaded",
+        set(load_json_data("gpx_id.json", [])) | set(load_json_data("new_gpx_id.json", []))
+        | Journal("new_gpx_id.jsonl").keys()
+    )
+    store.import_records("errors", load_json_data("error_links.json", []), kind="links")
+    store.import_records("errors", load_json_data("error_gpx.json", []), kind="gpx")
+
+
+# Если задана переменная окружения STATE_DB - состояние хранится в SQLite базе с этим именем.
+store = None
+if os.getenv("STATE_DB"):
+    store = StateStore(os.getenv("STATE_DB"))
+    if store.is_new:
+        import_json_state(store)
+
+# Новые ссылки со страниц передаются на проверку, ссылки на треки в пределах РФ - на загрузку.
+pipeline = Pipeline()
+chk_page = pipeline.stage(CheckNewPages(store=store))
+chk_links = pipeline.stage(CheckNewLinks(store=store), after=chk_page)
+load_gpx = pipeline.stage(DownloadGpxFile(store=store), after=chk_links)
 
 if __name__ == "__main__":
-    atr = AsyncTaskRuner(chunk_size=20, time_to_save=300)
-    atr.run(tasks)
+    # WORKERS - количество процессов-исполнителей задач, по умолчанию всё в одном процессе.
+    pipeline.run(chunk_size=20, time_to_save=300, workers=int(os.getenv("WORKERS", 0)))
+    store and store.close()
@@ -0,0 +1,363 @@
+"""
+Замер пропускной способности раннера и конвейеров без обращения к openstreetmap.org.
+
+Локальный сервер (aiohttp.web, в отдельном процессе) изображает сайт:
+    /traces/page/N   - страницы списка треков (per_page ссылок на странице, всего pages страниц);
+    /user/.../traces/ID - страницы треков с таблицей координат, доля russia из них - в РФ;
+    /trace/ID/data   - GPX файлы из gpx_points точек;
+    POST на любой другой адрес - приём треков от UploadGpxFile: один трек (ответ 201,
+    число точек) или пачка (json список треков, можно сжатый gzip; ответ 201, json
+    словарь id трека -> число точек).
+Время ответа случайное: логнормальное распределение с медианой latency секунд и
+разбросом jitter.
+
+Настоящие CheckNewPages -> CheckNewLinks -> DownloadGpxFile (и, с --upload, затем
+UploadGpxFile) запускаются во временной папке против этого сервера, по каждой стадии
+выводится количество задач, пропускная способность и точные p50/p99 времени выполнения
+задач (по времени каждой задачи, а не по корзинам гистограммы metrics.py).
+
+Память меряется для каждого конвейера отдельно: пиковая сумма PSS (RSS, в котором
+общие после fork страницы поделены между процессами) основного процесса и всех его
+дочерних - пула prepare и процессов-исполнителей (--workers), кроме сервера. Замер
+идёт по /proc (Linux) в отдельном потоке; в конце выводятся и пиковые RSS самого
+процесса и самого большого из завершившихся дочерних (getrusage).
+
+    python benchmark.py --pages 20 --per-page 20 --gpx-points 2000 --latency 0.05 --upload
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from metrics import Metrics
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Точки внутри и вне РФ для страниц треков.
+RUSSIA = (55.7558, 37.6173)
+ABROAD = (48.8566, 2.3522)
+
+
+def trace_id(page: int, index: int, per_page: int) -> int:
+    return 1000000 + (page - 1) * per_page + index
+
+
+def listing_page(page: int, config: dict) -> str:
+    if page > config["pages"]:
+        return "<html><body><p>No traces.</p></body></html>"
+    rows = "".join(
+        f'<tr><td><a href="/user/bench/traces/{gpx_id}">{gpx_id}.gpx</a></td></tr>'
+        for gpx_id in (trace_id(page, index, config["per_page"]) for index in range(config["per_page"]))
+    )
+    return f"<html><body><table>{rows}</table></body></html>"
+
+
+def trace_page(gpx_id: int, config: dict) -> str:
+    # Одна и та же доля треков в РФ при любом порядке запросов.
+    lat, lng = RUSSIA if random.Random(gpx_id).random() < config["russia"] else ABROAD
+    return (
+        "<html><body><table>"
+        f'<tr><td><a href="/trace/{gpx_id}/data">{gpx_id}.gpx</a></td></tr>'
+        f'<tr><td><span class="latitude">{lat}</span>, <span class="longitude">{lng}</span></td></tr>'
+        "</table></body></html>"
+    )
+
+
+def gpx_file(points: int) -> bytes:
+    start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    lat, lng = RUSSIA
+    trkpts = "".join(
+        f'<trkpt lat="{lat + i * 1e-4:.6f}" lon="{lng + i * 1e-4:.6f}"><ele>{150 + i % 10}</ele>'
+        f"<time>{(start + timedelta(seconds=5 * i)).strftime('%Y-%m-%dT%H:%M:%SZ')}</time></trkpt>"
+        for i in range(points)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">'
+        f"<trk><name>benchmark</name><trkseg>{trkpts}</trkseg></trk></gpx>"
+    ).encode("utf-8")
+
+
+def _serve_mock(connection, config: dict):
+    """Точка входа процесса сервера: сообщает свой адрес в connection и работает до завершения процесса."""
+    import asyncio
+    from aiohttp import web
+
+    gpx = gpx_file(config["gpx_points"])
+    mu, sigma = math.log(max(config["latency"], 1e-6)), config["jitter"]
+
+    async def delay():
+        if config["latency"]:
+            await asyncio.sleep(random.lognormvariate(mu, sigma))
+
+    async def page(request):
+        await delay()
+        return web.Response(text=listing_page(int(request.match_info["page"]), config), content_type="text/html")
+
+    async def trace(request):
+        await delay()
+        return web.Response(text=trace_page(int(request.match_info["id"]), config), content_type="text/html")
+
+    async def data(request):
+        await delay()
+        gpx_id = request.match_info["id"]
+        return web.Response(
+            body=gpx,
+            content_type="application/gpx+xml",
+            headers={"Content-Disposition": f'attachment; filename="{gpx_id}.gpx"'},
+        )
+
+    async def upload(request):
+        # Тело с Content-Encoding: gzip aiohttp распаковывает сам.
+        payload = json.loads(await request.read())
+        await delay()
+        if isinstance(payload, list):
+            return web.json_response({str(track["id"]): len(track["points"]) for track in payload}, status=201)
+        return web.Response(status=201, text=str(len(payload["points"])))
+
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_get("/traces/page/{page}", page)
+    app.router.add_get("/user/{user}/traces/{id}", trace)
+    app.router.add_get("/trace/{id}/data", data)
+    app.router.add_post("/{tail:.*}", upload)
+
+    async def main():
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        connection.send(f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}")
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+class MockServer:
+    """Локальный сервер в отдельном процессе, чтобы его работа не влияла на замеры."""
+
+    def __init__(self, config: dict):
+        context = multiprocessing.get_context("spawn")
+        connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_serve_mock, args=(child_connection, config), daemon=True)
+        self.process.start()
+        self.url = connection.recv()
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+
+
+class LatencyMetrics(Metrics):
+    """Metrics, которые хранят и время выполнения каждой задачи - для точных перцентилей."""
+
+    def __init__(self):
+        super().__init__(interval=0, log=False)
+        self.latencies = defaultdict(list)  # Имя класса задач -> время выполнения задач
+
+    def on_complete(self, name: str, seconds: float):
+        super().on_complete(name, seconds)
+        self.latencies[name].append(seconds)
+
+
+def percentile(values: list, q: float) -> float | None:
+    """Перцентиль q (0..1) с линейной интерполяцией между соседними значениями, None - значений нет."""
+    if not values:
+        return None
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return round(values[low] + (values[high] - values[low]) * (position - low), 4)
+
+
+def _memory_kb(pid: int) -> int:
+    """PSS процесса в килобайтах (если ядро его не отдаёт - RSS), 0 - процесса уже нет."""
+    for name, field in ((f"/proc/{pid}/smaps_rollup", "Pss:"), (f"/proc/{pid}/status", "VmRSS:")):
+        try:
+            with open(name) as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except OSError:
+            continue
+    return 0
+
+
+def _descendants(pid: int) -> list[int]:
+    """Все потомки процесса по /proc/PID/task/TID/children."""
+    result, stack = [], [pid]
+    while stack:
+        parent = stack.pop()
+        try:
+            threads = os.listdir(f"/proc/{parent}/task")
+        except OSError:
+            continue
+        for thread in threads:
+            try:
+                with open(f"/proc/{parent}/task/{thread}/children") as f:
+                    children = [int(child) for child in f.read().split()]
+            except OSError:
+                continue
+            result.extend(children)
+            stack.extend(children)
+    return result
+
+
+class MemorySampler:
+    """
+    Пиковая суммарная память процесса и его потомков (кроме exclude) за время
+    работы: опрос /proc в отдельном потоке каждые interval секунд.
+    """
+
+    def __init__(self, exclude: tuple = (), interval: float = 0.05):
+        self.exclude = set(exclude)
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        pids = [pid for pid in (os.getpid(), *_descendants(os.getpid())) if pid not in self.exclude]
+        self.peak_kb = max(self.peak_kb, sum(_memory_kb(pid) for pid in pids))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def peak_mb(self) -> float | None:
+        """None - /proc недоступен (не Linux)."""
+        return round(self.peak_kb / 1024, 1) if self.peak_kb else None
+
+
+def stage_report(metrics: LatencyMetrics, elapsed: float) -> dict:
+    """Количество задач, пропускная способность и точные p50/p99 по каждой стадии."""
+    return {
+        name: {
+            "tasks": stage.completed,
+            "per_second": round(stage.completed / elapsed, 2),
+            "p50": percentile(metrics.latencies[name], 0.5),
+            "p99": percentile(metrics.latencies[name], 0.99),
+            "errors": dict(stage.errors),
+        }
+        for name, stage in metrics.tasks.items()
+    }
+
+
+def run_download(chunk_size: int, workers: int = 0, exclude: tuple = ()) -> dict:
+    """Конвейер CheckNewPages -> CheckNewLinks -> DownloadGpxFile."""
+    from GPS_parser_OpenStreetMap import CheckNewLinks, CheckNewPages, DownloadGpxFile
+    from pipeline import Pipeline
+
+    pipeline = Pipeline()
+    pages = pipeline.stage(CheckNewPages())
+    links = pipeline.stage(CheckNewLinks(), after=pages)
+    pipeline.stage(DownloadGpxFile(), after=links)
+    return run_measured(pipeline.run, chunk_size, workers, exclude)
+
+
+def run_upload(chunk_size: int, batch_size: int = 1, workers: int = 0, exclude: tuple = ()) -> dict:
+    """UploadGpxFile для всех загруженных файлов, batch_size - треков в запросе."""
+    from support import AsyncTaskRuner
+    from upload_gpx import UploadGpxFile
+
+    UploadGpxFile.batch_size = batch_size
+    tasks = [UploadGpxFile()]
+    return run_measured(lambda **kwargs: AsyncTaskRuner(**kwargs).run(tasks), chunk_size, workers, exclude)
+
+
+def run_measured(run, chunk_size: int, workers: int = 0, exclude: tuple = ()) -> dict:
+    """Запускает run и меряет время, задачи стадий и память. exclude - pid процессов, которые не учитывать."""
+    metrics = LatencyMetrics()
+    with MemorySampler(exclude) as memory:
+        start = time.monotonic()
+        run(chunk_size=chunk_size, time_to_save=0, metrics=metrics, workers=workers)
+        elapsed = time.monotonic() - start
+    return {"seconds": round(elapsed, 3), "stages": stage_report(metrics, elapsed), "peak_memory_mb": memory.peak_mb}
+
+
+def main(argv: list[str] = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=10, help="страниц списка треков")
+    parser.add_argument("--per-page", type=int, default=20, help="треков на странице")
+    parser.add_argument("--russia", type=float, default=0.5, help="доля треков в РФ")
+    parser.add_argument("--gpx-points", type=int, default=1000, help="точек в GPX файле")
+    parser.add_argument("--latency", type=float, default=0.05, help="медиана времени ответа сервера, сек.")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс времени ответа (sigma логнормального)")
+    parser.add_argument("--chunk-size", type=int, default=20, help="chunk_size раннера")
+    parser.add_argument("--upload", action="store_true", help="затем залить загруженные треки (UploadGpxFile)")
+    parser.add_argument("--batch", type=int, default=1, help="треков в одном запросе заливки")
+    parser.add_argument("--workers", type=int, default=0, help="процессов-исполнителей задач (workers раннера)")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    args = parser.parse_args(argv)
+    config = {
+        "pages": args.pages,
+        "per_page": args.per_page,
+        "russia": args.russia,
+        "gpx_points": args.gpx_points,
+        "latency": args.latency,
+        "jitter": args.jitter,
+    }
+
+    server = MockServer(config)
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    # Файлы состояния задачи пишут в текущую папку - каждый замер начинается с чистого листа.
+    shutil.copy(os.path.join(ROOT, "russia.duration.json"), workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    os.environ["OSM_URL"] = server.url
+    os.environ["URL"] = server.url + "/api/"
+    os.environ.setdefault("BASIC_AUTH_GPS", "Basic YmVuY2htYXJrOg==")
+    report = {"config": {**config, "chunk_size": args.chunk_size, "batch": args.batch, "workers": args.workers}}
+    exclude = (server.process.pid,)
+    try:
+        report["download"] = run_download(args.chunk_size, args.workers, exclude)
+        if args.upload:
+            report["upload"] = run_upload(args.chunk_size, args.batch, args.workers, exclude)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.close()
+    # ru_maxrss в Linux - в килобайтах. Для RUSAGE_CHILDREN - максимум среди завершившихся
+    # дочерних процессов (в том числе сервера), а не сумма.
+    report["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    report["peak_child_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+
+    for name in ("download", "upload"):
+        if name not in report:
+            continue
+        print(f"{name}: {report[name]['seconds']} сек., пиковая память процессов: {report[name]['peak_memory_mb']} МБ")
+        for stage, values in report[name]["stages"].items():
+            print(
+                f"    {stage}: задач {values['tasks']}, {values['per_second']}/сек., "
+                f"p50 {values['p50']} сек., p99 {values['p99']} сек., ошибки {values['errors']}"
+            )
+    print(f"Пиковый RSS: процесса {report['peak_rss_mb']} МБ, дочернего процесса {report['peak_child_rss_mb']} МБ")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    main()
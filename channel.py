@@ -0,0 +1,130 @@
+"""
+Ограниченные очереди (каналы) для передачи данных между задачами.
+
+Канал хранит данные, которые одна задача передаёт на обработку другой. Если
+у канала задан размер и он заполнен, то производитель (await channel.put)
+приостанавливается до тех пор, пока потребитель не заберёт данные - так
+опережающие стадии конвейера не раздувают память. Порядок выдачи - FIFO или
+по приоритету (функция priority, меньшее значение выдаётся раньше).
+
+AsyncTaskRuner отмечает в контекстной переменной producer класс выполняемой
+задачи: канал знает какие классы ждут в нём места и не даёт раннеру запускать
+новые задачи этих классов, а место ждущей задачи отдаётся другим задачам.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from collections import Counter, deque
+
+# Класс задач (BaseTask), задача которого выполняется в текущем контексте.
+producer = contextvars.ContextVar("producer", default=None)
+
+
+class Channel:
+    """
+    Очередь данных задачи.
+
+    maxsize - размер очереди, 0 - без ограничения.
+    priority - функция приоритета элемента, None - FIFO.
+    Атрибут on_block - вызывается каждый раз когда производитель встаёт в ожидание.
+    Атрибут on_put - вызывается когда в пустой канал добавлен элемент.
+    """
+
+    def __init__(self, maxsize: int = 0, priority=None):
+        self.maxsize = maxsize
+        self.priority = priority
+        self._items = [] if priority is not None else deque()
+        self._counter = itertools.count()  # Сохраняет порядок элементов с равным приоритетом.
+        self._putters = deque()
+        self.blocked = Counter()  # Класс производителя -> количество его задач ждущих места.
+        self.on_block = None
+        self.on_put = None
+        self.closed = False
+        # Метрики
+        self.max_depth = 0
+        self.puts = 0
+        self.waits = 0
+        self.wait_time = 0.
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._items)
+
+    def close(self):
+        """Конец потока данных: больше в канал ничего не поступит."""
+        self.closed = True
+
+    def put_nowait(self, item):
+        """Добавляет элемент без ожидания, даже если канал заполнен."""
+        if self.closed:
+            raise RuntimeError("Канал закрыт, данные больше не принимаются.")
+        was_empty = not self._items
+        if self.priority is None:
+            self._items.append(item)
+        else:
+            heapq.heappush(self._items, (self.priority(item), next(self._counter), item))
+        self.puts += 1
+        self.max_depth = max(self.max_depth, len(self._items))
+        if was_empty and self.on_put is not None:
+            self.on_put()
+
+    async def put(self, item):
+        """Добавляет элемент, при заполненном канале ждёт пока освободится место."""
+        if self.full() or self._putters:
+            await self._wait_free()
+        self.put_nowait(item)
+
+    async def _wait_free(self):
+        loop = asyncio.get_running_loop()
+        task_class = producer.get()
+        self.blocked[task_class] += 1
+        self.waits += 1
+        start = time.monotonic()
+        try:
+            while True:
+                future = loop.create_future()
+                self._putters.append(future)
+                if self.on_block is not None:
+                    self.on_block()
+                try:
+                    await future
+                except BaseException:
+                    future.cancel()
+                    if future in self._putters:
+                        self._putters.remove(future)
+                    raise
+                if not self.full():
+                    return
+        finally:
+            self.blocked[task_class] -= 1
+            self.wait_time += time.monotonic() - start
+
+    def get_nowait(self):
+        """Забирает следующий элемент, если канал пуст - asyncio.QueueEmpty."""
+        if not self._items:
+            raise asyncio.QueueEmpty
+        if self.priority is None:
+            item = self._items.popleft()
+        else:
+            item = heapq.heappop(self._items)[2]
+        while self._putters:
+            future = self._putters.popleft()
+            if not future.done():
+                future.set_result(None)
+                break
+        return item
+
+    def stats(self) -> dict:
+        """Глубина очереди и время ожидания производителей."""
+        return {
+            "depth": len(self._items),
+            "max_depth": self.max_depth,
+            "puts": self.puts,
+            "waits": self.waits,
+            "wait_time": round(self.wait_time, 3),
+            "blocked": sum(self.blocked.values()),
+        }
@@ -0,0 +1,127 @@
+"""
+Адаптивное ограничение количества одновременно выполняемых задач класса.
+
+Алгоритм AIMD с учётом градиента задержки: после каждого окна наблюдений
+лимит увеличивается на единицу, если медианная задержка не выросла
+относительно базовой, и умножается на decrease, если выросла. Таймауты,
+ответы 429 и 5xx сразу уменьшают лимит (не чаще одного раза за окно).
+
+Для задач с сессией задержка и сигналы об HTTP ответах собираются через
+aiohttp.TraceConfig общей сессии задачи: задержка - от отправки заголовков
+запроса до получения ответа. Ожидание в своих же ограничениях (корзины токенов
+ratelimit, пул соединений, заполненный канал следующей стадии) в неё не входит,
+иначе лимит снижался бы из-за собственного торможения, а не из-за удалённой
+стороны. Для задач без сессии задержка - время выполнения задачи.
+"""
+import asyncio
+import statistics
+
+from fetch import transient_status
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AdaptiveLimit:
+    """
+    Лимит одновременных задач одного класса.
+
+    maximum - верхняя граница (как правило chunk_size раннера).
+    minimum - нижняя граница.
+    initial - стартовое значение.
+    decrease - множитель уменьшения при ошибках и росте задержки.
+    tolerance - во сколько раз медианная задержка может превысить базовую без снижения лимита.
+    window - минимальный размер окна наблюдений.
+    """
+
+    def __init__(
+            self,
+            maximum: int,
+            minimum: int = 1,
+            initial: int = None,
+            decrease: float = 0.7,
+            tolerance: float = 1.5,
+            window: int = 10,
+    ):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(min(maximum, initial or max(minimum, maximum // 4)))
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.window = window
+        self.baseline = None  # Базовая (минимальная наблюдаемая) медианная задержка.
+        self._latencies = []
+        self._errors = 0
+        self._backed_off = False  # Лимит уже снижен по ошибке в текущем окне.
+
+    @property
+    def value(self) -> int:
+        return max(self.minimum, min(self.maximum, int(self.limit)))
+
+    def _back_off(self):
+        self.limit = max(float(self.minimum), self.limit * self.decrease)
+
+    def on_latency(self, seconds: float):
+        """Вызывается с задержкой каждого запроса (для задач без сессии - каждой задачи)."""
+        self._latencies.append(seconds)
+        if len(self._latencies) >= max(self.window, self.value):
+            self._update()
+
+    def on_error(self):
+        """Таймаут, 429 или 5xx от удалённой стороны."""
+        self._errors += 1
+        if not self._backed_off:
+            self._backed_off = True
+            self._back_off()
+
+    def _update(self):
+        median = statistics.median(self._latencies)
+        if self.baseline is None:
+            self.baseline = median
+        if not self._errors:
+            if median <= self.baseline * self.tolerance:
+                self.limit = min(float(self.maximum), self.limit + 1)
+            else:
+                self._back_off()
+        # Базовая задержка медленно "забывается", чтобы подстроиться под изменения удалённой стороны.
+        self.baseline = min(median, self.baseline * 1.05)
+        self._latencies = []
+        self._errors = 0
+        self._backed_off = False
+
+    def trace_config(self):
+        """aiohttp.TraceConfig, сообщающий лимиту задержку запросов, 429/5xx ответы и таймауты."""
+        return limit_trace_config(self.on_error, self.on_latency)
+
+
+def limit_trace_config(on_error, on_latency):
+    """
+    aiohttp.TraceConfig для AdaptiveLimit: вызывает on_latency(seconds) с задержкой каждого
+    запроса (от отправки заголовков до получения ответа) и on_error() при 429/5xx ответах
+    и таймаутах (в процессах-исполнителях - чтобы передать сигналы лимиту основного процесса).
+    """
+    async def on_request_headers_sent(session, context, params):
+        context.sent = asyncio.get_running_loop().time()
+
+    async def on_request_end(session, context, params):
+        sent = getattr(context, "sent", None)
+        if sent is not None:
+            on_latency(asyncio.get_running_loop().time() - sent)
+        if transient_status(params.response.status):
+            on_error()
+
+    async def on_request_exception(session, context, params):
+        # При raise_for_status=True ответы 429/5xx приходят сюда в виде ClientResponseError.
+        exc = params.exception
+        if isinstance(exc, asyncio.TimeoutError) or (
+                isinstance(exc, aiohttp.ClientResponseError) and transient_status(exc.status)
+        ):
+            on_error()
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_headers_sent.append(on_request_headers_sent)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
@@ -0,0 +1,100 @@
+"""
+Поиск входных файлов в папке.
+
+DirectoryScanner перебирает папку через os.scandir (тип файла берётся из
+записи каталога, без отдельного stat на каждый файл) и запоминает уже
+выданные имена, так что повторный проход выдаёт только новые файлы.
+
+Если установлен watchdog и включено наблюдение (watch=True), то после первого
+полного прохода папка больше не перечитывается: новые файлы (созданные или
+перенесённые в папку, как это делает fetch.save_response) приходят событиями
+файловой системы (inotify в Linux).
+"""
+import os
+import queue
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class _Events(FileSystemEventHandler):
+    """Складывает имена новых файлов папки в очередь."""
+
+    def __init__(self, names: queue.SimpleQueue):
+        self.names = names
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.names.put(os.path.basename(event.src_path))
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.names.put(os.path.basename(event.dest_path))
+
+
+class DirectoryScanner:
+    """
+    Новые файлы папки.
+
+    path - папка.
+    match - функция отбора по имени файла.
+    watch - следить за папкой через watchdog вместо повторных проходов (если он установлен).
+    """
+
+    def __init__(self, path: str, match=None, watch: bool = False):
+        self.path = path
+        self.match = match
+        self.seen = set()  # Уже выданные имена
+        self._events = None
+        self._observer = None
+        if watch and Observer is None:
+            print("watchdog не установлен, новые файлы ищутся повторными проходами по папке.")
+        elif watch:
+            self._events = queue.SimpleQueue()
+            self._observer = Observer()
+            self._observer.schedule(_Events(self._events), path, recursive=False)
+            self._observer.start()
+        self._scanned = False
+
+    def _accept(self, name: str) -> bool:
+        return name not in self.seen and (self.match is None or self.match(name))
+
+    def _scan(self):
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if self._accept(entry.name) and entry.is_file():
+                    self.seen.add(entry.name)
+                    yield entry.name
+
+    def _drain(self):
+        while True:
+            try:
+                name = self._events.get_nowait()
+            except queue.Empty:
+                return
+            if self._accept(name) and os.path.isfile(os.path.join(self.path, name)):
+                self.seen.add(name)
+                yield name
+
+    def scan(self):
+        """Выдаёт имена файлов, которые ещё не выдавались."""
+        if self._observer is not None and self._scanned:
+            yield from self._drain()
+            return
+        self._scanned = True
+        yield from self._scan()
+
+    def forget(self, name: str):
+        """Файл name снова можно выдать (например, его надо обработать повторно)."""
+        self.seen.discard(name)
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
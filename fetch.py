@@ -0,0 +1,254 @@
+"""
+HTTP загрузки: потоковое сохранение ответов в файлы, докачка и условные запросы.
+
+Тело ответа читается частями (response.content.iter_chunked) и пишется во
+временный файл в папке .part рядом с целевым файлом, запись на диск идёт в
+потоках (run_in_executor), а event loop в это время читает следующую часть.
+После успешной загрузки файл сбрасывается на диск и атомарно переименовывается.
+В памяти одновременно держится не больше двух частей ответа.
+
+Если сессия открыта с auto_decompress=False, то сжатый сервером ответ
+(Content-Encoding: gzip) сохраняется как есть, а к имени файла добавляется
+расширение .gz (см. encoded_name).
+
+Fetcher делает запросы так, чтобы повторный запуск после аварии тратил трафик
+только на то, что изменилось:
+    - для страниц запоминаются валидаторы ответа (ETag, Last-Modified) и при
+      следующем запросе отправляются If-None-Match/If-Modified-Since, ответ 304 -
+      страница не изменилась;
+    - недокачанный файл остаётся в .part вместе с валидаторами ответа (файл
+      .part.json), при повторе запрашивается только остаток (Range + If-Range) и
+      ответ 206 дописывается в конец. Если файл на сервере изменился - сервер
+      вернёт его целиком (200) и загрузка начнётся заново.
+
+transient_error и retry_after помогают отличить временные ошибки (таймауты,
+обрывы соединения, 429 и 5xx) от постоянных, задачи с временными ошибками
+повторяются раннером (support.RetryTask).
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+from persistence import dumps, load_json_data, save_json_data, write_atomic
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+CHUNK_SIZE = 1 << 16
+
+# Content-Encoding -> расширение файла со сжатыми так данными.
+ENCODING_SUFFIXES = {"gzip": ".gz", "x-gzip": ".gz", "bzip2": ".bz2", "x-bzip2": ".bz2"}
+
+
+def encoded_name(name: str, response) -> str:
+    """
+    Имя файла для сохранения ответа без распаковки: если данные сжаты сервером, а имя
+    не отражает это - добавляется расширение .gz/.bz2.
+    """
+    suffix = ENCODING_SUFFIXES.get(response.headers.get("Content-Encoding", "").lower())
+    if suffix and not name.endswith(suffix):
+        return name + suffix
+    return name
+
+
+def part_path(path: str) -> str:
+    """Временный файл для загрузки в path."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, ".part", name + ".part")
+
+
+def meta_path(part: str) -> str:
+    """Файл с валидаторами ответа, часть которого сохранена в part."""
+    return part + ".json"
+
+
+def _remove(*names: str):
+    for name in names:
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def _content_range_start(response) -> int:
+    """Начало фрагмента из заголовка Content-Range: bytes start-end/total."""
+    value = response.headers.get("Content-Range", "")
+    try:
+        return int(value.split()[1].split("-")[0])
+    except (IndexError, ValueError):
+        return -1
+
+
+def _open_part(part: str, append: bool):
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    return open(part, "ab" if append else "wb")
+
+
+def _commit(file, part: str, path: str):
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+    os.replace(part, path)
+    _remove(meta_path(part))
+
+
+def _close(file, part: str, keep: bool):
+    file.close()
+    if not keep:
+        _remove(part, meta_path(part))
+
+
+async def save_response(response, path: str, chunk_size: int = CHUNK_SIZE, part: str = None) -> int:
+    """
+    Сохраняет тело ответа в файл path не загружая его целиком в память.
+    Возвращает количество записанных байт.
+
+    part - временный файл для докачки (см. Fetcher.get). Если он задан, то ответ 206
+    дописывается в его конец, а при ошибке загруженная часть сохраняется для повтора.
+    Без part временный файл выбирается по path и при ошибке удаляется.
+    """
+    loop = asyncio.get_running_loop()
+    keep = part is not None
+    part = part or part_path(path)
+    append = response.status == 206
+    if append:
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if _content_range_start(response) != offset:
+            _remove(part, meta_path(part))
+            raise ValueError(f"Фрагмент {response.headers.get('Content-Range')} не продолжает {part}.")
+    file = await loop.run_in_executor(None, _open_part, part, append)
+    size = 0
+    writing = None
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if writing is not None:
+                await writing
+            writing = loop.run_in_executor(None, file.write, chunk)
+            size += len(chunk)
+        if writing is not None:
+            await writing
+        await loop.run_in_executor(None, _commit, file, part, path)
+    except BaseException:
+        if writing is not None and not writing.done():
+            # Дожидаться записи нельзя (задачу могли отменить) - файл закрывается сразу.
+            writing.add_done_callback(lambda future: future.cancelled() or future.exception())
+        _close(file, part, keep)
+        raise
+    return size
+
+
+def transient_status(status: int) -> bool:
+    """Ответ с таким статусом стоит повторить позже: сервер перегружен или временно недоступен."""
+    return status == 429 or status >= 500
+
+
+def transient_error(exc: BaseException) -> bool:
+    """Временная ошибка запроса: таймаут, обрыв соединения или ответ 429/5xx."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    if aiohttp is None:
+        return False
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return transient_status(exc.status)
+    return isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+def retry_after(headers) -> float | None:
+    """Пауза в секундах из заголовка Retry-After (число секунд или дата), None - заголовка нет."""
+    value = headers and headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _validators(response) -> dict:
+    validators = {}
+    if response.headers.get("ETag"):
+        validators["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return validators
+
+
+class Fetcher:
+    """
+    Условные и докачиваемые GET запросы.
+
+    name - файл для валидаторов страниц (сохраняется методом save), None - не сохранять.
+    """
+
+    def __init__(self, name: str = None):
+        self.name = name
+        self.validators = load_json_data(name, {}) if name else {}
+
+    def save(self):
+        save_json_data(self.name, self.validators)
+
+    def _conditional_headers(self, url: str) -> dict:
+        validators = self.validators.get(url, {})
+        headers = {}
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+        return headers
+
+    @staticmethod
+    def _range_headers(part: str) -> dict:
+        """Заголовки для докачки part. Часть без валидаторов продолжать нельзя - она удаляется."""
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        validators = load_json_data(meta_path(part), {}) if offset else {}
+        etag = validators.get("etag", "")
+        # If-Range допускает только сильный ETag.
+        condition = etag if etag and not etag.startswith("W/") else validators.get("last_modified")
+        if not condition:
+            _remove(part, meta_path(part))
+            return {}
+        return {"Range": f"bytes={offset}-", "If-Range": condition}
+
+    @asynccontextmanager
+    async def get(self, session, url: str, part: str = None, **kwargs):
+        """
+        Замена session.get(url, **kwargs).
+
+        Без part - условный запрос страницы: 304 означает что она не изменилась с
+        прошлого запроса. Валидаторы страницы запоминаются только если блок async with
+        завершился без ошибки, то есть страница обработана.
+        С part (временный файл, затем передаётся в save_response) - загрузка с докачкой:
+        206 - сервер прислал остаток файла, 200 - файл целиком.
+        Ответы с ошибкой вызывают aiohttp.ClientResponseError, как при raise_for_status.
+        """
+        headers = kwargs.pop("headers", None) or {}
+        for attempt in range(2):
+            if part is None:
+                extra = self._conditional_headers(url)
+            else:
+                extra = self._range_headers(part)
+            async with session.get(url, headers={**headers, **extra}, raise_for_status=False, **kwargs) as response:
+                if response.status == 416 and part is not None and not attempt:
+                    # Сохранённая часть не подходит к файлу на сервере - загружаем его заново.
+                    _remove(part, meta_path(part))
+                    continue
+                if response.status >= 400:
+                    response.raise_for_status()
+                validators = _validators(response)
+                if part is not None and response.status == 200:
+                    os.makedirs(os.path.dirname(part), exist_ok=True)
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, write_atomic, meta_path(part), dumps(validators)
+                    )
+                yield response
+                if part is None and response.status == 200 and validators:
+                    self.validators[url] = validators
+                return
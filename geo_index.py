@@ -0,0 +1,89 @@
+"""
+Быстрая проверка вхождения точек в (мульти)полигон, например в границы страны.
+
+Полигон с десятками тысяч вершин дорого проверять на каждую точку, поэтому
+проверка идёт в три ступени:
+    1. Точка вне габаритного прямоугольника полигона - сразу "не входит".
+    2. По заранее рассчитанной сетке: ячейка целиком внутри полигона - "входит",
+       ячейка целиком снаружи - "не входит".
+    3. Только для ячеек через которые проходит граница - точная проверка по
+       подготовленной (shapely.prepare) геометрии.
+Результат совпадает с geometry.contains(Point(x, y)), в том числе для точек
+лежащих на границе (в том числе на линии разреза по 180-му меридиану).
+"""
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+class PolygonIndex:
+    """
+    Пространственный индекс для проверки вхождения точек в полигон.
+
+    geometry - shapely (Multi)Polygon.
+    step - размер ячейки сетки в градусах.
+    """
+
+    def __init__(self, geometry, step: float = 0.5):
+        self.geometry = geometry
+        shapely.prepare(self.geometry)
+        self.step = step
+        self.min_x, self.min_y, self.max_x, self.max_y = geometry.bounds
+        self.size_x = max(int(np.ceil((self.max_x - self.min_x) / step)), 1)
+        self.size_y = max(int(np.ceil((self.max_y - self.min_y) / step)), 1)
+        self.grid = self._build_grid()
+
+    @classmethod
+    def from_geojson(cls, feature: dict, step: float = 0.5):
+        """Строит индекс по GeoJSON объекту типа Feature (как russia.duration.json)."""
+        return cls(shape(feature["geometry"]), step=step)
+
+    def _build_grid(self):
+        """
+        Классифицирует ячейки сетки. Ячейки расширены на небольшой запас, чтобы
+        погрешность округления при вычислении номера ячейки точки не могла
+        привести к ошибке: расширенная ячейка целиком внутри (без касания границы)
+        или целиком снаружи гарантирует тот же ответ для любой её точки.
+        """
+        index_x, index_y = np.meshgrid(np.arange(self.size_x), np.arange(self.size_y), indexing="ij")
+        x0 = self.min_x + index_x.ravel() * self.step
+        y0 = self.min_y + index_y.ravel() * self.step
+        margin = self.step * 1e-3
+        boxes = shapely.box(x0 - margin, y0 - margin, x0 + self.step + margin, y0 + self.step + margin)
+
+        grid = np.full(boxes.shape, BOUNDARY, dtype=np.int8)
+        grid[shapely.contains_properly(self.geometry, boxes)] = INSIDE
+        grid[shapely.disjoint(self.geometry, boxes)] = OUTSIDE
+        return grid.reshape(self.size_x, self.size_y)
+
+    def contains(self, x: float, y: float) -> bool:
+        """Проверяет одну точку (x - долгота, y - широта)."""
+        if not (self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y):
+            return False
+        cell = self.grid[
+            min(int((x - self.min_x) / self.step), self.size_x - 1),
+            min(int((y - self.min_y) / self.step), self.size_y - 1),
+        ]
+        if cell != BOUNDARY:
+            return cell == INSIDE
+        return bool(shapely.contains_xy(self.geometry, x, y))
+
+    def contains_xy(self, x, y) -> np.ndarray:
+        """Векторная проверка массивов координат, возвращает массив bool."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        result = np.zeros(x.shape, dtype=bool)
+
+        in_bounds = (self.min_x <= x) & (x <= self.max_x) & (self.min_y <= y) & (y <= self.max_y)
+        cell_x = np.minimum(((x[in_bounds] - self.min_x) / self.step).astype(np.int64), self.size_x - 1)
+        cell_y = np.minimum(((y[in_bounds] - self.min_y) / self.step).astype(np.int64), self.size_y - 1)
+        cells = self.grid[cell_x, cell_y]
+
+        checked = cells == INSIDE
+        boundary = cells == BOUNDARY
+        if boundary.any():
+            checked[boundary] = shapely.contains_xy(self.geometry, x[in_bounds][boundary], y[in_bounds][boundary])
+        result[in_bounds] = checked
+        return result
@@ -0,0 +1,175 @@
+"""
+Векторизованный расчёт скорости и направления движения для точек GPX сегмента.
+
+Полностью повторяет логику поточечного цикла gpxpy (segment.get_speed(index),
+atan2 и strftime на каждую точку), но считает всё одним проходом по массивам
+NumPy. Точки, для которых gpxpy вернул бы speed is None, отбрасываются так же.
+Значения могут отличаться от поточечного расчёта лишь в последнем знаке
+(векторные sin/cos/atan2 NumPy против math).
+
+Для заливки точки не собираются в один большой список словарей: столбцы
+сегментов объединяются (concat_columns) и кодируются в json частями (points_json).
+Время в столбцах хранится как datetime64 (8 байт на точку) и переводится в
+строку только для кодируемой части точек.
+"""
+import json
+from datetime import timedelta
+
+import numpy as np
+
+# Константы gpxpy.geo
+EARTH_RADIUS = 6378.137 * 1000
+ONE_DEGREE = (2 * np.pi * EARTH_RADIUS) / 360
+RAD_TO_GRAD = 180 / np.pi
+ONE_SECOND = np.timedelta64(1, "s")
+
+
+def _haversine(lat1, lng1, lat2, lng2):
+    """gpxpy.geo.haversine_distance для массивов."""
+    d_lng = np.radians(lng1 - lng2)
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    d_lat = lat1 - lat2
+    a = np.sin(d_lat / 2) ** 2 + np.sin(d_lng / 2) ** 2 * np.cos(lat1) * np.cos(lat2)
+    return EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a))
+
+
+def _distance(lat1, lng1, ele1, lat2, lng2, ele2):
+    """
+    gpxpy.geo.distance для массивов: на коротких расстояниях плоская аппроксимация
+    с учётом высоты, на длинных (больше 0.2 градуса) - гаверсинус.
+    Важно: коэффициент долготы берётся по широте первой точки, как в gpxpy.
+    """
+    x = lat1 - lat2
+    y = (lng1 - lng2) * np.cos(np.radians(lat1))
+    distance_2d = np.sqrt(x * x + y * y) * ONE_DEGREE
+    d_ele = ele1 - ele2
+    use_ele = ~np.isnan(d_ele) & (d_ele != 0)
+    distance_3d = np.where(use_ele, np.sqrt(distance_2d ** 2 + np.where(use_ele, d_ele, 0) ** 2), distance_2d)
+    far = (np.abs(lat1 - lat2) > .2) | (np.abs(lng1 - lng2) > .2)
+    if far.any():
+        distance_3d = np.where(far, _haversine(lat1, lng1, lat2, lng2), distance_3d)
+    return distance_3d
+
+
+def _times(points):
+    """
+    Возвращает два массива datetime64[us]: локальное время точек (для вывода, как в
+    strftime) и время в UTC (для разницы между точками). Отсутствующее время - NaT.
+    """
+    stamps = [point.time for point in points]
+    local = np.array([None if t is None else t.replace(tzinfo=None) for t in stamps], dtype="datetime64[us]")
+    offsets = {t.utcoffset() for t in stamps if t is not None}
+    if len(offsets) <= 1:
+        # Все точки в одном часовом поясе - разница локального времени совпадает с разницей UTC.
+        return local, local
+    offsets = np.array(
+        [0 if t is None else (t.utcoffset() or timedelta()) // timedelta(microseconds=1) for t in stamps],
+        dtype="timedelta64[us]",
+    )
+    return local, local - offsets
+
+
+def segment_columns(points) -> dict:
+    """
+    Считает для списка точек сегмента (GPXTrackPoint) координаты, время, скорость и
+    направление. Возвращает словарь массивов одинаковой длины: lat, lng, timestamp
+    (локальное время, datetime64[us], строкой его делает format_timestamps), speed,
+    angle - только для точек со скоростью.
+    """
+    count = len(points)
+    lat = np.fromiter((point.latitude for point in points), dtype=np.float64, count=count)
+    lng = np.fromiter((point.longitude for point in points), dtype=np.float64, count=count)
+    if count < 2:
+        # Без соседей скорость не определена, gpxpy вернёт None.
+        empty = np.empty(0, dtype=np.float64)
+        return {
+            "lat": empty, "lng": empty, "timestamp": np.empty(0, dtype="datetime64[us]"), "speed": empty, "angle": empty,
+        }
+
+    ele = np.array([point.elevation for point in points], dtype=np.float64)  # None -> nan
+    local, utc = _times(points)
+
+    # Всё что ниже считается для пар соседних точек (k, k + 1).
+    dt = utc[1:] - utc[:-1]
+    has_time = ~np.isnat(dt)
+    seconds = np.abs(np.where(has_time, dt, np.timedelta64(0, "us"))) / ONE_SECOND
+    has_time &= seconds != 0
+    seconds = np.where(has_time, seconds, 1.0)
+
+    # Скорость точки k по следующей точке и точки k + 1 по предыдущей.
+    forward = _distance(lat[:-1], lng[:-1], ele[:-1], lat[1:], lng[1:], ele[1:]) / seconds
+    backward = _distance(lat[1:], lng[1:], ele[1:], lat[:-1], lng[:-1], ele[:-1]) / seconds
+
+    # Для каждой точки: speed_1 - по предыдущей, speed_2 - по следующей.
+    speed_1 = np.insert(np.where(has_time, backward, 0.), 0, 0.)
+    speed_2 = np.append(np.where(has_time, forward, 0.), 0.)
+    has_speed_2 = np.append(has_time, False)
+    # Логика GPXTrackSegment.get_speed: среднее если обе скорости ненулевые, иначе
+    # ненулевая speed_1, иначе speed_2 (в том числе нулевая), иначе None.
+    speed_1_ok = speed_1 != 0
+    speed_2_ok = speed_2 != 0
+    speed = np.where(speed_1_ok & speed_2_ok, (speed_1 + speed_2) / 2, np.where(speed_1_ok, speed_1, speed_2))
+    mask = speed_1_ok | has_speed_2
+    speed = speed[mask]
+
+    # Направление: на следующую точку, у последней точки - с предыдущей.
+    dlat = lat[1:] - lat[:-1]
+    dlng = lng[1:] - lng[:-1]
+    dlat = np.append(dlat, dlat[-1])
+    dlng = np.append(dlng, dlng[-1])
+    angle = (np.arctan2(dlng[mask], dlat[mask]) * RAD_TO_GRAD) % 360
+
+    return {"lat": lat[mask], "lng": lng[mask], "timestamp": local[mask], "speed": speed, "angle": angle}
+
+
+def format_timestamps(timestamp: np.ndarray) -> list[str]:
+    """Время datetime64[us] строками как strftime("%Y-%m-%d %H:%M:%S.%f")."""
+    if not timestamp.size:
+        return []
+    return np.char.replace(np.datetime_as_string(timestamp, unit="us"), "T", " ").tolist()
+
+
+def segment_points(points) -> list[dict]:
+    """Те же данные что и segment_columns, но в виде списка словарей для json."""
+    columns = segment_columns(points)
+    return [
+        {"lat": lat, "lng": lng, "timestamp": timestamp, "speed": speed, "angle": angle}
+        for lat, lng, timestamp, speed, angle in zip(
+            columns["lat"].tolist(),
+            columns["lng"].tolist(),
+            format_timestamps(columns["timestamp"]),
+            columns["speed"].tolist(),
+            columns["angle"].tolist(),
+        )
+    ]
+
+
+def concat_columns(columns: list[dict]) -> dict:
+    """Объединяет столбцы нескольких сегментов (segment_columns) в одни массивы."""
+    names = ("lat", "lng", "timestamp", "speed", "angle")
+    if not columns:
+        return {name: np.empty(0, dtype="datetime64[us]" if name == "timestamp" else np.float64) for name in names}
+    return {name: np.concatenate([column[name] for column in columns]) for name in names}
+
+
+def points_json(columns: dict, chunk_size: int = 2000):
+    """
+    Кодирует точки из столбцов в json частями по chunk_size точек: выдаёт строки
+    с элементами списка точек (без скобок), как их записал бы json.dumps(segment_points).
+    В памяти одновременно держится только одна часть точек в виде словарей и строк времени.
+    """
+    count = len(columns["lat"])
+    for start in range(0, count, chunk_size):
+        end = start + chunk_size
+        chunk = [
+            {"lat": lat, "lng": lng, "timestamp": timestamp, "speed": speed, "angle": angle}
+            for lat, lng, timestamp, speed, angle in zip(
+                columns["lat"][start:end].tolist(),
+                columns["lng"][start:end].tolist(),
+                format_timestamps(columns["timestamp"][start:end]),
+                columns["speed"][start:end].tolist(),
+                columns["angle"][start:end].tolist(),
+            )
+        ]
+        yield json.dumps(chunk)[1:-1]
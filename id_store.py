@@ -0,0 +1,363 @@
+"""
+Компактные множества и словари статусов для числовых id треков OSM.
+
+Обычные set[str] и dict[str, int] тратят на каждый id больше сотни байт.
+IdSet и IdStatusDict хранят id как отсортированный массив NumPy int64
+(статусы - параллельный массив int16), то есть 8-10 байт на запись. Поиск -
+двоичный (np.searchsorted). Новые записи копятся в небольшом буфере (обычные
+set/dict) и вливаются в массивы пачками, так что добавление не требует
+перестройки массива на каждую запись.
+
+Ключи принимаются как числа или как строки из цифр (как в json файлах задач),
+ключи другого вида (is_id) пропускаются с сообщением, а не вызывают ошибку -
+иначе одна испорченная запись в json файле или журнале ломала бы каждый
+запуск. При переборе ключи выдаются строками - контейнеры подменяют прежние set[str] и
+dict[str, int] без изменения кода задач: поддерживаются in, |, get, перебор,
+len, items.
+
+Содержимое сохраняется в компактный двоичный файл (dump/load). load_ids читает
+его вместо json файла задачи, если он не старше json.
+"""
+import os
+import struct
+
+import numpy as np
+
+from persistence import load_json_data, save_bytes, save_json_data
+
+# Сколько новых записей копить в буфере перед вливанием в массив.
+MERGE_SIZE = 4096
+
+_HEADER = struct.Struct("<4sQ")
+
+
+# id хранятся в int64.
+MAX_ID = 2**63 - 1
+
+
+def is_id(key) -> bool:
+    """key - id трека: неотрицательное целое в пределах int64 или строка из цифр ASCII."""
+    if isinstance(key, str):
+        return key.isascii() and key.isdigit() and int(key) <= MAX_ID
+    return isinstance(key, (int, np.integer)) and not isinstance(key, bool) and bool(0 <= key <= MAX_ID)
+
+
+def _key(key) -> int | None:
+    """Числовое значение id или None, если key - не id (см. is_id)."""
+    return int(key) if is_id(key) else None
+
+
+def _skip(key):
+    print(f"Пропущен не числовой id трека: {key!r}")
+
+
+def _valid_keys(keys):
+    """Числовые значения id из keys, не id пропускаются с сообщением."""
+    for key in keys:
+        value = _key(key)
+        if value is None:
+            _skip(key)
+        else:
+            yield value
+
+
+def _merge(ids: np.ndarray, new_ids: np.ndarray, values: np.ndarray = None, new_values: np.ndarray = None):
+    """
+    Вливает новые id (и значения) в отсортированный массив ids. Значения уже
+    существующих id заменяются новыми. new_ids должны быть уникальны.
+    """
+    order = np.argsort(new_ids, kind="stable")
+    new_ids = new_ids[order]
+    positions = np.searchsorted(ids, new_ids)
+    found = positions < len(ids)
+    found[found] = ids[positions[found]] == new_ids[found]
+    if values is not None:
+        new_values = new_values[order]
+        values[positions[found]] = new_values[found]
+        values = np.insert(values, positions[~found], new_values[~found])
+    ids = np.insert(ids, positions[~found], new_ids[~found])
+    return ids, values
+
+
+def _find(ids: np.ndarray, key: int) -> int:
+    """Индекс key в отсортированном ids или -1."""
+    index = int(np.searchsorted(ids, key))
+    if index < len(ids) and ids[index] == key:
+        return index
+    return -1
+
+
+def _read(name: str, magic: bytes) -> tuple[int, bytearray, int]:
+    with open(name, "rb") as f:
+        data = bytearray(f.read())
+    file_magic, count = _HEADER.unpack_from(data)
+    if file_magic != magic:
+        raise ValueError(f"{name}: неизвестный формат {file_magic!r}.")
+    return count, data, _HEADER.size
+
+
+class IdSet:
+    """Множество числовых id."""
+
+    __slots__ = ("_ids", "_added")
+    MAGIC = b"IDS1"
+
+    def __init__(self, items=()):
+        self._ids = np.empty(0, dtype=np.int64)
+        self._added = set()
+        self.update(items)
+
+    def _flush(self):
+        if self._added:
+            self._ids, _ = _merge(self._ids, np.fromiter(self._added, dtype=np.int64, count=len(self._added)))
+            self._added = set()
+
+    def add(self, key):
+        number = _key(key)
+        if number is None:
+            _skip(key)
+            return
+        if _find(self._ids, number) < 0:
+            self._added.add(number)
+            if len(self._added) >= MERGE_SIZE:
+                self._flush()
+
+    def update(self, items):
+        if isinstance(items, IdSet):
+            items._flush()
+            new_ids = items._ids
+        else:
+            new_ids = np.unique(np.fromiter(_valid_keys(items), dtype=np.int64))
+        if len(new_ids):
+            self._flush()
+            self._ids, _ = _merge(self._ids, new_ids)
+
+    def __contains__(self, key) -> bool:
+        key = _key(key)
+        if key is None:
+            return False
+        return key in self._added or _find(self._ids, key) >= 0
+
+    def __len__(self) -> int:
+        self._flush()
+        return len(self._ids)
+
+    def __iter__(self):
+        self._flush()
+        ids = self._ids
+        for start in range(0, len(ids), MERGE_SIZE):
+            yield from map(str, ids[start:start + MERGE_SIZE].tolist())
+
+    def copy(self) -> "IdSet":
+        self._flush()
+        result = IdSet()
+        result._ids = self._ids.copy()
+        return result
+
+    def __or__(self, other) -> "IdSet":
+        result = self.copy()
+        result.update(other)
+        return result
+
+    __ror__ = __or__
+
+    def to_json(self) -> bytes:
+        """json список id-строк, как сохранялось множество строк."""
+        self._flush()
+        return ("[" + ",".join(f'"{key}"' for key in self._ids.tolist()) + "]").encode("utf-8")
+
+    def to_bytes(self) -> bytes:
+        self._flush()
+        return _HEADER.pack(self.MAGIC, len(self._ids)) + self._ids.astype("<i8").tobytes()
+
+    def dump(self, name: str):
+        """Сохраняет множество в двоичный файл name."""
+        save_bytes(name, self.to_bytes())
+
+    @classmethod
+    def load(cls, name: str) -> "IdSet":
+        count, data, offset = _read(name, cls.MAGIC)
+        result = cls()
+        result._ids = np.frombuffer(data, dtype="<i8", count=count, offset=offset).astype(np.int64, copy=False)
+        return result
+
+
+class IdStatusDict:
+    """Словарь числовой id -> статус (целое от -32768 до 32767)."""
+
+    __slots__ = ("_ids", "_values", "_added")
+    MAGIC = b"IDD1"
+
+    def __init__(self, items=()):
+        self._ids = np.empty(0, dtype=np.int64)
+        self._values = np.empty(0, dtype=np.int16)
+        self._added = {}
+        self.update(items)
+
+    def _flush(self):
+        if self._added:
+            count = len(self._added)
+            self._ids, self._values = _merge(
+                self._ids,
+                np.fromiter(self._added.keys(), dtype=np.int64, count=count),
+                self._values,
+                np.fromiter(self._added.values(), dtype=np.int16, count=count),
+            )
+            self._added = {}
+
+    def __setitem__(self, key, value):
+        number = _key(key)
+        if number is None:
+            _skip(key)
+            return
+        index = _find(self._ids, number)
+        if index >= 0:
+            self._values[index] = value
+            return
+        self._added[number] = value
+        if len(self._added) >= MERGE_SIZE:
+            self._flush()
+
+    def update(self, items):
+        if isinstance(items, IdStatusDict):
+            items._flush()
+            new_ids, new_values = items._ids, items._values
+        else:
+            if hasattr(items, "items"):
+                items = items.items()
+            # Последнее значение ключа побеждает, как у dict.
+            valid = {}
+            for key, value in items:
+                number = _key(key)
+                if number is None:
+                    _skip(key)
+                else:
+                    valid[number] = value
+            items = valid
+            new_ids = np.fromiter(items.keys(), dtype=np.int64, count=len(items))
+            new_values = np.fromiter(items.values(), dtype=np.int16, count=len(items))
+        if len(new_ids):
+            self._flush()
+            self._ids, self._values = _merge(self._ids, new_ids, self._values, new_values)
+
+    def get(self, key, default=None):
+        key = _key(key)
+        if key is None:
+            return default
+        if key in self._added:
+            return self._added[key]
+        index = _find(self._ids, key)
+        return int(self._values[index]) if index >= 0 else default
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+    def __len__(self) -> int:
+        self._flush()
+        return len(self._ids)
+
+    def items(self):
+        self._flush()
+        ids, values = self._ids, self._values
+        for start in range(0, len(ids), MERGE_SIZE):
+            end = start + MERGE_SIZE
+            yield from zip(map(str, ids[start:end].tolist()), values[start:end].tolist())
+
+    def __iter__(self):
+        for key, _ in self.items():
+            yield key
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def select(self, value: int) -> IdSet:
+        """id со статусом value."""
+        self._flush()
+        result = IdSet()
+        result._ids = self._ids[self._values == value]
+        return result
+
+    def copy(self) -> "IdStatusDict":
+        self._flush()
+        result = IdStatusDict()
+        result._ids = self._ids.copy()
+        result._values = self._values.copy()
+        return result
+
+    def __or__(self, other) -> "IdStatusDict":
+        result = self.copy()
+        result.update(other)
+        return result
+
+    def __ror__(self, other) -> "IdStatusDict":
+        result = IdStatusDict(other)
+        result.update(self)
+        return result
+
+    def to_json(self) -> bytes:
+        """json словарь id-строка -> статус, как сохранялся dict[str, int]."""
+        self._flush()
+        return (
+            "{" + ",".join(f'"{key}":{value}' for key, value in zip(self._ids.tolist(), self._values.tolist())) + "}"
+        ).encode("utf-8")
+
+    def to_bytes(self) -> bytes:
+        self._flush()
+        return (
+            _HEADER.pack(self.MAGIC, len(self._ids))
+            + self._ids.astype("<i8").tobytes()
+            + self._values.astype("<i2").tobytes()
+        )
+
+    def dump(self, name: str):
+        """Сохраняет словарь в двоичный файл name."""
+        save_bytes(name, self.to_bytes())
+
+    @classmethod
+    def load(cls, name: str) -> "IdStatusDict":
+        count, data, offset = _read(name, cls.MAGIC)
+        result = cls()
+        result._ids = np.frombuffer(data, dtype="<i8", count=count, offset=offset).astype(np.int64, copy=False)
+        offset += count * 8
+        result._values = np.frombuffer(data, dtype="<i2", count=count, offset=offset).astype(np.int16, copy=False)
+        return result
+
+
+def binary_name(json_name: str) -> str:
+    """Имя двоичного файла для json файла задачи: rus_links.json -> rus_links.ids."""
+    return os.path.splitext(json_name)[0] + ".ids"
+
+
+def load_ids(json_name: str, cls=IdSet):
+    """
+    Загружает IdSet или IdStatusDict: из двоичного файла, если он есть и не старше
+    json файла (json мог быть изменён вручную), иначе из json.
+    """
+    binary = binary_name(json_name)
+    try:
+        binary_time = os.path.getmtime(binary)
+    except OSError:
+        binary_time = None
+    json_time = os.path.getmtime(json_name) if os.path.exists(json_name) else None
+    if binary_time is not None and (json_time is None or binary_time >= json_time):
+        try:
+            return cls.load(binary)
+        except (OSError, ValueError, struct.error) as exc:
+            print(f"Не удалось прочитать {binary}: {exc}")
+    return cls(load_json_data(json_name, {} if cls is IdStatusDict else []))
+
+
+def save_ids(json_name: str, data):
+    """Сохраняет IdSet или IdStatusDict в json файл задачи и рядом - в двоичный."""
+    save_json_data(json_name, data)
+    data.dump(binary_name(json_name))
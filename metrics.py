@@ -0,0 +1,286 @@
+"""
+Метрики работы AsyncTaskRuner.
+
+По каждому классу задач собираются: гистограмма времени выполнения задач,
+количество выполняемых задач, глубина очереди (канала), количество
+завершённых задач и скорость их завершения, ошибки по типам исключений
+(для RetryTask - тип исходного исключения, учитываются и ошибки, которые
+задача обработала сама, см. BaseTask.error), задачи ушедшие в dead_letter и
+длительность сохранений (checkpoint). Общая для процесса метрика - задержка
+event loop: насколько позже положенного просыпается периодическая проверка.
+
+Метрики выводятся периодически одной строкой json в stdout, а в формате
+Prometheus (text exposition format) записываются в файл и/или отдаются по
+HTTP на localhost (любой GET, например /metrics).
+"""
+import asyncio
+import bisect
+import json
+import time
+from collections import Counter
+
+from persistence import write_atomic
+
+# Границы корзин гистограмм в секундах.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 300.)
+
+
+def error_type(error: BaseException | str) -> str:
+    """
+    Тип ошибки для метрик: для исключения-обёртки (raise RetryTask(...) from exc) - тип
+    исходного исключения. error может быть уже готовым именем типа.
+    """
+    if isinstance(error, str):
+        return error
+    # Исключение из процесса-исполнителя: __cause__ через pickle не передаётся, тип записан заранее.
+    recorded = getattr(error, "error_type", None)
+    if recorded is not None:
+        return recorded
+    if error.__cause__ is not None:
+        return error_type(error.__cause__)
+    return error.__class__.__name__
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (как histogram в Prometheus)."""
+
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Оценка квантиля q по верхней границе корзины, None - наблюдений нет."""
+        if not self.count:
+            return None
+        rank, total = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        """Строки (le, накопленное количество) для экспорта."""
+        total = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            total += count
+            yield str(bound), total
+
+
+class TaskMetrics:
+    """Метрики одного класса задач."""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.checkpoint = Histogram()
+        self.completed = 0
+        self.errors = Counter()  # Имя класса исключения -> количество
+        self.dead_letters = 0
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.retries_pending = 0
+
+
+class Metrics:
+    """
+    Сборщик метрик.
+
+    interval - период вывода строки метрик и записи файла в секундах.
+    path - файл для метрик в формате Prometheus, None - не записывать.
+    port - порт HTTP сервера метрик на localhost, None - не запускать.
+    log - выводить строку метрик в stdout.
+    Атрибут refresh - вызывается перед каждым выводом, чтобы обновить мгновенные значения
+    (выполняемые задачи, глубину очередей).
+    """
+
+    def __init__(self, interval: float = 60, path: str = None, port: int = None, log: bool = True):
+        self.interval = interval
+        self.path = path
+        self.port = port
+        self.log = log
+        self.refresh = None
+        self.tasks = {}  # Имя класса задач -> TaskMetrics
+        self.loop_lag = Histogram()
+        self.max_loop_lag = 0.
+        self._completed = Counter()  # Завершённые задачи на момент прошлого вывода
+        self._time = time.monotonic()
+        self._background = []
+
+    def task(self, name: str) -> TaskMetrics:
+        metrics = self.tasks.get(name)
+        if metrics is None:
+            metrics = self.tasks[name] = TaskMetrics()
+        return metrics
+
+    def on_complete(self, name: str, seconds: float):
+        """Задача класса name завершилась (успешно или нет) за seconds секунд."""
+        metrics = self.task(name)
+        metrics.latency.observe(seconds)
+        metrics.completed += 1
+
+    def on_error(self, name: str, error: BaseException | str):
+        """Ошибка задачи класса name: исключение или имя его типа (см. error_type)."""
+        self.task(name).errors[error_type(error)] += 1
+
+    def on_dead_letter(self, name: str):
+        """Задача класса name не выполнилась за все попытки."""
+        self.task(name).dead_letters += 1
+
+    def on_checkpoint(self, name: str, seconds: float):
+        self.task(name).checkpoint.observe(seconds)
+
+    def on_loop_lag(self, seconds: float):
+        self.loop_lag.observe(seconds)
+        self.max_loop_lag = max(self.max_loop_lag, seconds)
+
+    def _refresh(self):
+        if self.refresh is not None:
+            self.refresh()
+
+    def snapshot(self) -> dict:
+        """Метрики одним словарем; скорость завершения - с момента прошлого вызова."""
+        self._refresh()
+        now = time.monotonic()
+        elapsed = max(now - self._time, 1e-9)
+        self._time = now
+        tasks = {}
+        for name, metrics in self.tasks.items():
+            p50, p99 = metrics.latency.quantile(0.5), metrics.latency.quantile(0.99)
+            tasks[name] = {
+                "completed": metrics.completed,
+                "per_second": round((metrics.completed - self._completed[name]) / elapsed, 3),
+                "in_flight": metrics.in_flight,
+                "queue_depth": metrics.queue_depth,
+                "retries_pending": metrics.retries_pending,
+                "p50": p50,
+                "p99": p99,
+                "errors": dict(metrics.errors),
+                "dead_letters": metrics.dead_letters,
+                "checkpoint_max": metrics.checkpoint.quantile(1.),
+            }
+            self._completed[name] = metrics.completed
+        return {"time": round(time.time(), 3), "tasks": tasks, "loop_lag_max": round(self.max_loop_lag, 4)}
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus."""
+        self._refresh()
+        lines = []
+
+        def histogram(name: str, help: str, values: dict):
+            lines.extend((f"# HELP {name} {help}", f"# TYPE {name} histogram"))
+            for labels, hist in values.items():
+                for le, count in hist.samples():
+                    lines.append(f'{name}_bucket{{{labels}le="{le}"}} {count}')
+                lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {hist.sum}")
+                lines.append(f"{name}_count{{{labels.rstrip(',')}}} {hist.count}")
+
+        def simple(name: str, kind: str, help: str, values: dict):
+            lines.extend((f"# HELP {name} {help}", f"# TYPE {name} {kind}"))
+            for labels, value in values.items():
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        task_labels = {name: f'task="{name}",' for name in self.tasks}
+        histogram(
+            "task_latency_seconds", "Время выполнения задачи.",
+            {task_labels[name]: metrics.latency for name, metrics in self.tasks.items()},
+        )
+        histogram(
+            "task_checkpoint_seconds", "Длительность сохранения результатов.",
+            {task_labels[name]: metrics.checkpoint for name, metrics in self.tasks.items()},
+        )
+        simple(
+            "task_completed_total", "counter", "Завершённые задачи.",
+            {task_labels[name][:-1]: metrics.completed for name, metrics in self.tasks.items()},
+        )
+        simple(
+            "task_errors_total", "counter", "Ошибки задач по типу исключения.",
+            {
+                f'{task_labels[name]}exception="{exception}"': count
+                for name, metrics in self.tasks.items()
+                for exception, count in metrics.errors.items()
+            },
+        )
+        simple(
+            "task_dead_letters_total", "counter", "Задачи не выполнившиеся за все попытки.",
+            {task_labels[name][:-1]: metrics.dead_letters for name, metrics in self.tasks.items()},
+        )
+        simple(
+            "task_in_flight", "gauge", "Выполняемые задачи.",
+            {task_labels[name][:-1]: metrics.in_flight for name, metrics in self.tasks.items()},
+        )
+        simple(
+            "task_queue_depth", "gauge", "Данные в очереди (канале) задачи.",
+            {task_labels[name][:-1]: metrics.queue_depth for name, metrics in self.tasks.items()},
+        )
+        simple(
+            "task_retries_pending", "gauge", "Задачи ждущие повтора.",
+            {task_labels[name][:-1]: metrics.retries_pending for name, metrics in self.tasks.items()},
+        )
+        histogram("event_loop_lag_seconds", "Задержка event loop.", {"": self.loop_lag})
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Записывает метрики в формате Prometheus в файл self.path."""
+        if self.path:
+            write_atomic(self.path, self.prometheus().encode("utf-8"))
+
+    def report(self):
+        """Выводит строку метрик и обновляет файл."""
+        if self.log:
+            print("--- Метрики:", json.dumps(self.snapshot(), ensure_ascii=False))
+        self.write()
+
+    async def _monitor_loop(self, period: float = 0.1):
+        """Измеряет насколько позже положенного просыпается event loop."""
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(period)
+            self.on_loop_lag(max(0., time.monotonic() - start - period))
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    async def _handle(self, reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = self.prometheus().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        """Запускает фоновые измерения, периодический вывод и HTTP сервер."""
+        self._time = time.monotonic()
+        self._background = [asyncio.create_task(self._monitor_loop())]
+        if self.interval:
+            self._background.append(asyncio.create_task(self._report_loop()))
+        if self.port is not None:
+            self._background.append(await asyncio.start_server(self._handle, "127.0.0.1", self.port))
+
+    async def stop(self):
+        """Останавливает фоновые задачи и выводит итоговые метрики."""
+        for background in self._background:
+            if isinstance(background, asyncio.Task):
+                background.cancel()
+            else:
+                background.close()
+                await background.wait_closed()
+        self._background = []
+        self.report()
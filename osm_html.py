@@ -0,0 +1,299 @@
+"""
+Извлечение данных со страниц https://www.openstreetmap.org/ без построения
+полного дерева BeautifulSoup.
+
+trace_links(html) - ссылки на треки со страницы списка треков (все <a href>,
+текст которых заканчивается на ".gpx").
+trace_details(html) - ссылка на файл и координаты со страницы трека (первая
+<table>: первая <a href>, текст <span class="latitude"> и <span class="longitude">).
+
+Парсер выбирается из доступных по скорости: selectolax, lxml, потоковый
+html.parser.HTMLParser (стандартная библиотека, разбор прекращается как только
+нужные поля найдены). Задать парсер явно можно переменной окружения
+OSM_HTML_PARSER (selectolax, lxml, stream, bs4). Если выбранный парсер упал -
+страница разбирается BeautifulSoup, как раньше.
+
+Сверка результатов всех парсеров с BeautifulSoup и замер скорости на
+сохранённых страницах (без аргументов - на страницах из папки osm_pages/:
+списки треков, страницы треков с координатами и без, страница без таблицы),
+при расхождениях код возврата 1:
+    python osm_html.py [page1.html page2.html ...]
+"""
+import glob
+import os
+import sys
+import time
+from html.parser import HTMLParser
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxParser
+    except ImportError:
+        SelectolaxParser = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+
+def _decode(html) -> str:
+    return html.decode("utf-8", "replace") if isinstance(html, bytes) else html
+
+
+def _has_class(attrs: dict, name: str) -> bool:
+    return name in (attrs.get("class") or "").split()
+
+
+class _Stop(Exception):
+    """Все нужные данные найдены, дальше страницу можно не разбирать."""
+
+
+class _LinksParser(HTMLParser):
+    """Собирает href и текст всех ссылок <a href> страницы."""
+
+    def __init__(self):
+        super().__init__()
+        self.anchors = []  # [href, [части текста]] в порядке появления на странице
+        self._open = []  # Незакрытые ссылки (ссылки могут быть вложены друг в друга)
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        attrs = dict(attrs)
+        if "href" in attrs:
+            anchor = [attrs["href"] or "", []]
+            self.anchors.append(anchor)
+        else:
+            anchor = None
+        self._open.append(anchor)
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self._open:
+            self._open.pop()
+
+    def handle_data(self, data):
+        for anchor in self._open:
+            if anchor is not None:
+                anchor[1].append(data)
+
+
+class _DetailsParser(HTMLParser):
+    """Разбирает первую <table> страницы трека и прекращает разбор как только всё найдено."""
+
+    def __init__(self):
+        super().__init__()
+        self.table = False
+        self.href = None
+        self.lat = None
+        self.lng = None
+        self._table_depth = 0
+        self._span = None  # "lat" или "lng" - текст какого поля сейчас собирается
+        self._span_depth = 0
+        self._text = []
+
+    def _check_done(self):
+        if self.href is not None and self.lat is not None and self.lng is not None:
+            raise _Stop
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self.table = True
+            self._table_depth += 1
+            return
+        if not self._table_depth:
+            return
+        if tag == "span":
+            if self._span is not None:
+                self._span_depth += 1
+                return
+            attrs = dict(attrs)
+            if self.lat is None and _has_class(attrs, "latitude"):
+                self._span, self._span_depth, self._text = "lat", 1, []
+            elif self.lng is None and _has_class(attrs, "longitude"):
+                self._span, self._span_depth, self._text = "lng", 1, []
+        elif tag == "a" and self.href is None:
+            attrs = dict(attrs)
+            if "href" in attrs:
+                self.href = attrs["href"] or ""
+                self._check_done()
+
+    def handle_endtag(self, tag):
+        if tag == "span" and self._span is not None:
+            self._span_depth -= 1
+            if not self._span_depth:
+                self._close_span()
+        elif tag == "table" and self._table_depth:
+            self._table_depth -= 1
+            if not self._table_depth:
+                # В разбор попадает только первая таблица страницы.
+                if self._span is not None:
+                    self._close_span()
+                raise _Stop
+
+    def _close_span(self):
+        setattr(self, self._span, "".join(self._text))
+        self._span = None
+        self._check_done()
+
+    def handle_data(self, data):
+        if self._span is not None:
+            self._text.append(data)
+
+
+def _stream_links(html) -> list[str]:
+    parser = _LinksParser()
+    parser.feed(_decode(html))
+    parser.close()
+    return [href for href, text in parser.anchors if "".join(text).endswith(".gpx")]
+
+
+def _stream_details(html):
+    parser = _DetailsParser()
+    try:
+        parser.feed(_decode(html))
+        parser.close()
+        if parser._span is not None:
+            # Документ закончился внутри span - его текст всё равно засчитывается.
+            parser._close_span()
+    except _Stop:
+        pass
+    if not parser.table:
+        return None
+    return parser.href, parser.lat, parser.lng
+
+
+def _bs4_links(html) -> list[str]:
+    soup = BeautifulSoup(html, "html.parser")
+    return [a["href"] for a in soup.find_all("a", href=True) if a.text.endswith(".gpx")]
+
+
+def _bs4_details(html):
+    soup = BeautifulSoup(html, "html.parser")
+    table = soup.find("table")
+    if not table:
+        return None
+    link = table.find("a", href=True)
+    lat = table.find("span", {"class": "latitude"})
+    lng = table.find("span", {"class": "longitude"})
+    return link and link["href"], lat and lat.text, lng and lng.text
+
+
+def _selectolax_links(html) -> list[str]:
+    tree = SelectolaxParser(html)
+    return [
+        node.attributes["href"] or ""
+        for node in tree.css("a[href]")
+        if node.text(deep=True).endswith(".gpx")
+    ]
+
+
+def _selectolax_details(html):
+    table = SelectolaxParser(html).css_first("table")
+    if table is None:
+        return None
+    link = table.css_first("a[href]")
+    lat = table.css_first("span.latitude")
+    lng = table.css_first("span.longitude")
+    return (
+        link and (link.attributes["href"] or ""),
+        lat and lat.text(deep=True),
+        lng and lng.text(deep=True),
+    )
+
+
+def _span_xpath(name: str) -> str:
+    return f".//span[contains(concat(' ', normalize-space(@class), ' '), ' {name} ')]"
+
+
+def _lxml_links(html) -> list[str]:
+    document = lxml.html.document_fromstring(html)
+    return [
+        a.get("href")
+        for a in document.iter("a")
+        if a.get("href") is not None and a.text_content().endswith(".gpx")
+    ]
+
+
+def _lxml_details(html):
+    table = lxml.html.document_fromstring(html).find(".//table")
+    if table is None:
+        return None
+    link = table.find(".//a[@href]")
+    lat = table.xpath(_span_xpath("latitude"))
+    lng = table.xpath(_span_xpath("longitude"))
+    return (
+        None if link is None else link.get("href"),
+        lat[0].text_content() if lat else None,
+        lng[0].text_content() if lng else None,
+    )
+
+
+PARSERS = {"stream": (_stream_links, _stream_details)}
+if BeautifulSoup is not None:
+    PARSERS["bs4"] = (_bs4_links, _bs4_details)
+if lxml is not None:
+    PARSERS["lxml"] = (_lxml_links, _lxml_details)
+if SelectolaxParser is not None:
+    PARSERS["selectolax"] = (_selectolax_links, _selectolax_details)
+
+# Сохранённые страницы для сверки парсеров.
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "osm_pages")
+
+PARSER = os.getenv("OSM_HTML_PARSER") or next(name for name in ("selectolax", "lxml", "stream") if name in PARSERS)
+
+
+def _extract(kind: int, html):
+    try:
+        return PARSERS[PARSER][kind](html)
+    except Exception:
+        if BeautifulSoup is None or PARSER == "bs4":
+            raise
+        return PARSERS["bs4"][kind](html)
+
+
+def trace_links(html) -> list[str]:
+    """Ссылки на треки (href) со страницы списка треков https://www.openstreetmap.org/traces/page/N."""
+    return _extract(0, html)
+
+
+def trace_details(html):
+    """
+    Данные страницы трека https://www.openstreetmap.org/user/<user>/traces/<id>.
+    Возвращает None если на странице нет таблицы, иначе (href, lat, lng) - ссылка на
+    файл трека и текст координат, None для того чего в таблице нет.
+    """
+    return _extract(1, html)
+
+
+def _benchmark(names: list[str], repeat: int = 20):
+    pages = []
+    for name in names:
+        with open(name, "rb") as f:
+            pages.append(f.read())
+    failed = False
+    for kind, title in ((0, "trace_links"), (1, "trace_details")):
+        expected = [PARSERS["bs4"][kind](page) for page in pages]
+        print(f"{title}:")
+        for parser, functions in PARSERS.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                results = [functions[kind](page) for page in pages]
+            elapsed = (time.perf_counter() - start) / repeat / len(pages) * 1000
+            differ = [name for name, result, reference in zip(names, results, expected) if result != reference]
+            failed = failed or bool(differ)
+            print(f"    {parser:<10} {elapsed:8.3f} мс/страница  {'расхождения: ' + ', '.join(differ) if differ else 'ok'}")
+    return failed
+
+
+if __name__ == "__main__":
+    if BeautifulSoup is None:
+        sys.exit("Для сверки нужен BeautifulSoup (bs4).")
+    sys.exit(_benchmark(sys.argv[1:] or sorted(glob.glob(os.path.join(PAGES, "*.html")))))
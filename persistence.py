@@ -0,0 +1,136 @@
+"""
+Надёжное сохранение данных в json.
+
+Запись идёт во временный файл с fsync и атомарной заменой целевого файла через
+os.replace, поэтому авария посреди записи не оставит обрезанный файл. Если
+сохранение вызвано изнутри работающего event loop, то сериализация и запись
+выполняются в отдельном потоке, а event loop не блокируется. Все такие записи
+идут в одном потоке строго по очереди. Если установлен orjson - используется
+он (компактный вывод без отступов), иначе стандартный json.
+"""
+import asyncio
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Один поток - записи в файлы выполняются строго в порядке вызова.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save_json_data")
+_pending = set()
+
+
+def dumps(data) -> bytes:
+    """Сериализует данные в компактный json (utf-8)."""
+    if hasattr(data, "to_json"):
+        # Компактные контейнеры (id_store) кодируют себя сами.
+        return data.to_json()
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes):
+    """Разбирает json."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def snapshot(data):
+    """
+    Неглубокая копия контейнера на момент вызова, чтобы его можно было
+    сериализовать в другом потоке пока задачи продолжают его менять.
+    Множества превращаются в списки.
+    """
+    if hasattr(data, "to_json"):
+        return data.copy()
+    if isinstance(data, (set, frozenset, list, tuple)):
+        return list(data)
+    if isinstance(data, dict):
+        return dict(data)
+    return data
+
+
+def write_atomic(name: str, payload: bytes):
+    """Записывает payload во временный файл, сбрасывает его на диск и атомарно подменяет name."""
+    tmp_name = f"{name}.tmp"
+    with open(tmp_name, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, name)
+
+
+def _save(name: str, data):
+    write_atomic(name, dumps(data))
+
+
+def _report(future):
+    _pending.discard(future)
+    exc = future.exception()
+    if exc is not None:
+        print("Ошибка сохранения данных:", exc)
+        traceback.print_exception(exc)
+
+
+def _submit(function, *args):
+    """Ставит запись в очередь фонового потока, если вызвана из работающего event loop, иначе пишет сразу."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        function(*args)
+        return
+    future = _executor.submit(function, *args)
+    _pending.add(future)
+    future.add_done_callback(_report)
+    return future
+
+
+def save_bytes(name: str, payload: bytes):
+    """Атомарно записывает payload в файл name, в той же очереди что и save_json_data."""
+    return _submit(write_atomic, name, payload)
+
+
+def save_json_data(name: str, data):
+    """
+    Сохраняет данные в формате json (учтите что не всё можно сохранить без
+    написания специального класса или без предварительного переводжа данных
+    в строку или список, множества сохраняются как списки).
+
+    Вызванная из работающего event loop - ставит запись в очередь фонового
+    потока и возвращает concurrent.futures.Future, иначе пишет сразу.
+    """
+    if not name:
+        return
+    return _submit(_save, name, snapshot(data))
+
+
+def wait_saved():
+    """Дожидается завершения всех отложенных записей."""
+    for future in list(_pending):
+        try:
+            future.result()
+        except Exception:
+            pass  # Уже выведено в _report.
+
+
+def load_json_data(name: str, default=None):
+    """
+    Читает данные из json файла.
+
+    name - имя файла.
+    default - передаваемое значение по умолчанию если файла нет или он не читается.
+    """
+    try:
+        with open(name, "rb") as f:
+            return loads(f.read())
+    except FileNotFoundError:
+        return default
+    except Exception as exc:
+        print(f"Не удалось прочитать {name}: {exc}")
+        return default
@@ -0,0 +1,60 @@
+"""
+Декларативное описание конвейера задач.
+
+Вместо ручного связывания задач через append и плоского списка для
+AsyncTaskRuner.run конвейер описывается стадиями и связями между ними:
+
+    pipeline = Pipeline()
+    pages = pipeline.stage(CheckNewPages())
+    links = pipeline.stage(CheckNewLinks(), after=pages)
+    gpx = pipeline.stage(DownloadGpxFile(), after=links)
+    pipeline.run(chunk_size=20)
+
+Стадия передаёт данные следующим через await self.emit(data). Зная граф,
+раннер завершает стадию, как только её предыдущие стадии завершены и данных
+для неё больше нет (конец потока передаётся вниз по графу), и заканчивает
+работу сразу как только завершены все стадии.
+"""
+from support import AsyncTaskRuner, BaseTask
+
+
+class Pipeline:
+    """Граф стадий конвейера. Стадии добавляются только после всех своих предыдущих стадий."""
+
+    def __init__(self):
+        self.stages = []
+        self.graph = {}  # Стадия -> список следующих стадий
+
+    def stage(self, task: BaseTask, after: BaseTask | list[BaseTask] = None) -> BaseTask:
+        """
+        Добавляет стадию в конвейер.
+
+        task - задача стадии.
+        after - предыдущая стадия или список стадий, от которых task получает данные.
+        """
+        if task in self.graph:
+            raise ValueError(f"Стадия {task.__class__.__name__} уже добавлена в конвейер.")
+        if after is None:
+            after = []
+        elif isinstance(after, BaseTask):
+            after = [after]
+        for upstream in after:
+            if upstream not in self.graph:
+                raise ValueError(f"Стадия {upstream.__class__.__name__} не добавлена в конвейер.")
+        for upstream in after:
+            self.graph[upstream].append(task)
+            upstream.outputs.append(task)
+        self.stages.append(task)
+        self.graph[task] = []
+        return task
+
+    def run(self, runner: AsyncTaskRuner = None, **kwargs) -> AsyncTaskRuner:
+        """
+        Запускает конвейер.
+
+        runner - готовый AsyncTaskRuner, иначе он создаётся с параметрами kwargs.
+        """
+        if runner is None:
+            runner = AsyncTaskRuner(**kwargs)
+        runner.run(self.stages, graph=self.graph)
+        return runner
@@ -0,0 +1,163 @@
+"""
+Профилирование этапов работы AsyncTaskRuner.
+
+По каждому классу задач и этапу учитывается количество вызовов, время (wall)
+и процессорное время (CPU) event loop потока:
+    next   - выбор данных (put/append или next() генератора data_generator);
+    logger - вызов logger перед запуском задачи;
+    prepare - prepare, если он выполняется в event loop (без пула процессов);
+    task   - выполнение task: время считается по шагам корутины между await, так
+             что ожидание сети не попадает в CPU время;
+    result - обработка результата раннером (учёт, лимиты, метрики, повтор);
+    save   - сохранение результатов (save).
+Любой синхронный участок (вызов этапа или шаг корутины task) дольше threshold
+секунд блокирует event loop - он выводится сразу и подсчитывается отдельно.
+
+С profile=True для каждого класса задач ведётся cProfile (только на время его
+этапов), в конце работы профиль записывается в файл profile-<класс>.prof
+(смотреть через python -m pstats или snakeviz).
+
+Если задачи выполняются в процессах-исполнителях (workers), этап task в основном
+процессе - это лишь ожидание ответа исполнителя.
+"""
+import cProfile
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class PhaseStats:
+    """Накопленные значения одного этапа."""
+
+    __slots__ = ("calls", "wall", "cpu", "max_wall", "blocked")
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.max_wall = 0.
+        self.blocked = 0
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "wall": round(self.wall, 3),
+            "cpu": round(self.cpu, 3),
+            "max_wall": round(self.max_wall, 4),
+            "blocked": self.blocked,
+        }
+
+
+class Profiler:
+    """
+    threshold - сколько секунд синхронный участок может занимать event loop без предупреждения.
+    profile - вести cProfile для каждого класса задач.
+    path - папка для файлов профилей.
+    """
+
+    def __init__(self, threshold: float = 0.1, profile: bool = False, path: str = "."):
+        self.threshold = threshold
+        self.profile = profile
+        self.path = path
+        self.phases = defaultdict(PhaseStats)  # (имя класса, этап) -> PhaseStats
+        self._profiles = {}  # Имя класса -> cProfile.Profile
+
+    def _profile(self, name: str):
+        profile = self._profiles.get(name)
+        if profile is None:
+            profile = self._profiles[name] = cProfile.Profile()
+        return profile
+
+    def record(self, name: str, phase: str, wall: float, cpu: float, calls: int = 1):
+        stats = self.phases[name, phase]
+        stats.calls += calls
+        stats.wall += wall
+        stats.cpu += cpu
+
+    def _step(self, name: str, phase: str, wall: float):
+        """Учитывает один синхронный участок: максимальное время и блокировку event loop."""
+        stats = self.phases[name, phase]
+        stats.max_wall = max(stats.max_wall, wall)
+        if wall > self.threshold:
+            stats.blocked += 1
+            print(f"--- Блокировка event loop: {name}.{phase} {wall:.3f} сек.")
+
+    @contextmanager
+    def phase(self, task_class, phase: str):
+        """Замеряет синхронный этап класса задач."""
+        name = task_class.__class__.__name__
+        profile = self._profile(name) if self.profile else None
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall = time.perf_counter() - start
+            self.record(name, phase, wall, time.thread_time() - start_cpu)
+            self._step(name, phase, wall)
+
+    def timed(self, task_class, coro, phase: str = "task"):
+        """Обёртка корутины, замеряющая каждый её шаг между await."""
+        return _Timed(self, task_class.__class__.__name__, phase, coro)
+
+    def stats(self) -> dict:
+        """Этапы по убыванию общего времени: первый - кандидат на оптимизацию."""
+        items = sorted(self.phases.items(), key=lambda item: item[1].wall, reverse=True)
+        return {f"{name}.{phase}": stats.stats() for (name, phase), stats in items}
+
+    def report(self):
+        """Выводит итоги и записывает профили."""
+        print("--- Профиль этапов (wall, cpu - сек.):")
+        for phase, stats in self.stats().items():
+            print(f"    {phase}: {stats}")
+        for name, profile in self._profiles.items():
+            file_name = os.path.join(self.path, f"profile-{name}.prof")
+            profile.dump_stats(file_name)
+            print(f"--- Профиль {name} записан в {file_name}")
+
+
+class _Timed:
+    """Выполняет корутину по шагам, замеряя время и CPU каждого шага."""
+
+    def __init__(self, profiler: Profiler, name: str, phase: str, coro):
+        self.profiler = profiler
+        self.name = name
+        self.phase = phase
+        self.coro = coro
+
+    def __await__(self):
+        profiler, coro = self.profiler, self.coro
+        profile = profiler._profile(self.name) if profiler.profile else None
+        wall = cpu = 0.
+        send, value = coro.send, None
+        try:
+            while True:
+                start, start_cpu = time.perf_counter(), time.thread_time()
+                if profile is not None:
+                    profile.enable()
+                try:
+                    future = send(value)
+                except StopIteration as exc:
+                    return exc.value
+                finally:
+                    if profile is not None:
+                        profile.disable()
+                    step = time.perf_counter() - start
+                    wall += step
+                    cpu += time.thread_time() - start_cpu
+                    profiler._step(self.name, self.phase, step)
+                try:
+                    value = yield future
+                    send = coro.send
+                except GeneratorExit:
+                    coro.close()
+                    raise
+                except BaseException as exc:
+                    # Отмена или ошибка ожидания передаётся в корутину.
+                    send, value = coro.throw, exc
+        finally:
+            profiler.record(self.name, self.phase, wall, cpu)
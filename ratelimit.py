@@ -0,0 +1,162 @@
+"""
+Ограничение частоты запросов к удалённым хостам (token bucket).
+
+Для каждого хоста заводятся корзины токенов: запросы в секунду и байты в
+секунду. Корзины общие для всех задач, обращающихся к одному хосту, так что
+несколько классов задач вместе не превышают заданную скорость. Если классы
+задают для хоста разную скорость - действует меньшая.
+
+Запросы учитываются через aiohttp.TraceConfig сессии задачи (см.
+BaseTask.requests_per_second и BaseTask.bytes_per_second): перед отправкой
+запрос ждёт токен, а объём ответа списывается по Content-Length (или по
+фактически прочитанному через read(), если длина не известна). Токены берутся
+в долг, поэтому большой ответ задерживает следующие запросы к хосту.
+
+Ответы 429 и 503 временно снижают скорость запросов к хосту вдвое (и
+выдерживают паузу Retry-After), каждый успешный ответ понемногу возвращает её
+к заданной - так скорость держится около предела, который терпит сервер.
+"""
+import asyncio
+import time
+
+from fetch import retry_after
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class TokenBucket:
+    """
+    Корзина токенов.
+
+    rate - пополнение токенов в секунду.
+    capacity - размер корзины (допустимый всплеск), по умолчанию - запас на 1 секунду.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity or max(1., rate)
+        self.tokens = self.capacity
+        self._time = time.monotonic()
+        # Метрики
+        self.acquired = 0.
+        self.waits = 0
+        self.wait_time = 0.
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def limit(self, rate: float):
+        """Снижает заданную скорость до rate (если она больше)."""
+        if rate < self.max_rate:
+            self._refill()
+            self.max_rate = rate
+            self.rate = min(self.rate, rate)
+
+    async def acquire(self, amount: float = 1.):
+        """Забирает amount токенов, если их не хватает - ждёт пока долг будет погашен."""
+        self._refill()
+        self.tokens -= amount
+        self.acquired += amount
+        if self.tokens < 0:
+            delay = -self.tokens / self.rate
+            self.waits += 1
+            self.wait_time += delay
+            await asyncio.sleep(delay)
+
+    def slow_down(self, pause: float = None):
+        """Сервер просит снизить частоту: скорость вдвое ниже, pause - пауза в секундах."""
+        self._refill()
+        self.rate = max(self.max_rate / 20, self.rate / 2)
+        if pause:
+            self.tokens = min(self.tokens, -pause * self.rate)
+
+    def speed_up(self):
+        """Успешный ответ: скорость понемногу возвращается к заданной."""
+        if self.rate < self.max_rate:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+    def stats(self) -> dict:
+        return {
+            "rate": round(self.rate, 3),
+            "acquired": round(self.acquired),
+            "waits": self.waits,
+            "wait_time": round(self.wait_time, 3),
+        }
+
+
+class HostLimits:
+    """
+    Корзины токенов по хостам.
+
+    Атрибут scale - доля заданной скорости, приходящаяся на этот процесс (в
+    процессах-исполнителях AsyncTaskRuner(workers=N) - 1 / N).
+    """
+
+    def __init__(self):
+        self.scale = 1.
+        self._buckets = {}  # (хост, "requests" | "bytes") -> TokenBucket
+
+    def bucket(self, host: str, kind: str, rate: float) -> TokenBucket:
+        rate *= self.scale
+        bucket = self._buckets.get((host, kind))
+        if bucket is None:
+            bucket = self._buckets[host, kind] = TokenBucket(rate)
+        else:
+            bucket.limit(rate)
+        return bucket
+
+    def trace_config(self, requests_per_second: float = None, bytes_per_second: float = None):
+        """aiohttp.TraceConfig, ограничивающий запросы сессии к каждому хосту."""
+        async def on_request_start(session, context, params):
+            if requests_per_second:
+                await self.bucket(params.url.host, "requests", requests_per_second).acquire()
+
+        async def on_request_end(session, context, params):
+            response = params.response
+            context.counted = bool(response.content_length)
+            if requests_per_second:
+                bucket = self.bucket(params.url.host, "requests", requests_per_second)
+                if response.status in (429, 503):
+                    bucket.slow_down(retry_after(response.headers))
+                elif response.status < 400:
+                    bucket.speed_up()
+            if bytes_per_second and response.content_length:
+                await self.bucket(params.url.host, "bytes", bytes_per_second).acquire(response.content_length)
+
+        async def on_request_exception(session, context, params):
+            # При raise_for_status=True ответы 429/503 приходят сюда в виде ClientResponseError.
+            exc = params.exception
+            if (
+                    requests_per_second
+                    and isinstance(exc, aiohttp.ClientResponseError)
+                    and exc.status in (429, 503)
+            ):
+                bucket = self.bucket(params.url.host, "requests", requests_per_second)
+                bucket.slow_down(retry_after(exc.headers))
+
+        async def on_response_chunk_received(session, context, params):
+            # Только ответы без Content-Length, остальные уже учтены в on_request_end.
+            if bytes_per_second and not getattr(context, "counted", False):
+                await self.bucket(params.url.host, "bytes", bytes_per_second).acquire(len(params.chunk))
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        return trace_config
+
+    def stats(self) -> dict:
+        """Метрики корзин: текущая скорость, выданные токены, ожидания."""
+        return {f"{host} {kind}": bucket.stats() for (host, kind), bucket in self._buckets.items()}
+
+
+# Общие для всех задач процесса корзины.
+HOST_LIMITS = HostLimits()
@@ -0,0 +1,186 @@
+"""
+Хранилище состояния конвейера в SQLite (режим WAL) вместо json файлов
+page_links.json, rus_links.json, gpx_id.json, error_*.json и description.json.
+
+При работе с хранилищем задачи не держат в памяти всю историю: проверка
+"было ли уже" идёт индексированным запросом, а генераторы данных читают
+ожидающие обработки записи потоком. Новые результаты копятся пачкой и
+записываются одной транзакцией при периодическом сохранении - для этого
+хранилище выдаёт объекты-журналы (см. support.Journal), которые подставляются
+в JournalSet/JournalDict/JournalList.
+"""
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS page_links (link TEXT PRIMARY KEY, id TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS links (id TEXT PRIMARY KEY, status INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS links_status ON links (status);
+CREATE TABLE IF NOT EXISTS downloaded (id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS errors (kind TEXT NOT NULL, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS descriptions (id TEXT PRIMARY KEY, names TEXT NOT NULL);
+"""
+
+# Для каждой таблицы: запрос на вставку/обновление и преобразование записи журнала (ключ, значение) в строку.
+UPSERTS = {
+    "page_links": (
+        "INSERT OR IGNORE INTO page_links (link, id) VALUES (?, ?)",
+        lambda key, value: (key, key.split("/")[-1]),
+    ),
+    "links": (
+        "INSERT INTO links (id, status) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET status = excluded.status",
+        lambda key, value: (key, value),
+    ),
+    "downloaded": (
+        "INSERT OR IGNORE INTO downloaded (id) VALUES (?)",
+        lambda key, value: (key,),
+    ),
+    "descriptions": (
+        "INSERT INTO descriptions (id, names) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET names = excluded.names",
+        lambda key, value: (key, json.dumps(value, ensure_ascii=False)),
+    ),
+}
+
+# Статусы ссылок: -10..-1 - ошибка (повторить), 0 - не РФ, 1 - РФ, загрузить, 2 - обработана.
+# Запросы на чтение потоком (см. StateStore._stream): страница строк с rowid от ? (не включая) до ?.
+PENDING_LINKS = """
+SELECT page_links.rowid, page_links.link FROM page_links LEFT JOIN links ON links.id = page_links.id
+WHERE page_links.rowid > ? AND page_links.rowid <= ? AND (links.status IS NULL OR links.status BETWEEN -10 AND -1)
+ORDER BY page_links.rowid LIMIT ?
+"""
+PENDING_DOWNLOADS = """
+SELECT links.rowid, links.id FROM links
+WHERE links.rowid > ? AND links.rowid <= ? AND links.status = 1
+AND NOT EXISTS (SELECT 1 FROM downloaded WHERE downloaded.id = links.id)
+ORDER BY links.rowid LIMIT ?
+"""
+
+
+class StoreJournal:
+    """
+    Журнал с тем же интерфейсом что и support.Journal, но пишущий в таблицу
+    хранилища. flush - одна транзакция на все накопленные изменения.
+    """
+
+    def __init__(self, store: "StateStore", table: str, kind: str = None):
+        self.store = store
+        self.table = table
+        self.kind = kind  # Для таблицы errors - тип ошибки.
+        self._records = []
+
+    def write(self, key, value=None):
+        self._records.append((key, value))
+
+    def flush(self):
+        if not self._records:
+            return
+        if self.table == "errors":
+            sql = "INSERT INTO errors (kind, data) VALUES (?, ?)"
+            rows = [(self.kind, json.dumps(key, ensure_ascii=False)) for key, _ in self._records]
+        else:
+            sql, row = UPSERTS[self.table]
+            rows = [row(key, value) for key, value in self._records]
+        with self.store.connection:
+            self.store.connection.executemany(sql, rows)
+        self._records = []
+
+    def keys(self) -> set:
+        """История хранится в базе, в память она не поднимается."""
+        return set()
+
+    def items(self) -> dict:
+        return {}
+
+    def remove(self):
+        """Данные хранилища не удаляются при завершении, сбрасываются только накопленные изменения."""
+        self.flush()
+
+
+class StoreKeys:
+    """Представление таблицы как множества ключей: проверка `in` идёт запросом по индексу."""
+
+    def __init__(self, store: "StateStore", table: str, column: str):
+        self.store = store
+        self._contains = f"SELECT 1 FROM {table} WHERE {column} = ? LIMIT 1"
+        self._count = f"SELECT count(*) FROM {table}"
+
+    def __contains__(self, key) -> bool:
+        return self.store.connection.execute(self._contains, (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.store.connection.execute(self._count).fetchone()[0]
+
+
+class StateStore:
+    """
+    Хранилище состояния.
+
+    name - имя файла базы данных.
+    Атрибут is_new - True если база была создана только что (можно импортировать json).
+    """
+
+    def __init__(self, name: str = "state.sqlite3"):
+        self.name = name
+        self.connection = sqlite3.connect(name)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.is_new = self.connection.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == 0
+        self.connection.executescript(SCHEMA)
+        self.page_links = StoreKeys(self, "page_links", "link")
+        self.downloaded = StoreKeys(self, "downloaded", "id")
+        self.links = StoreKeys(self, "links", "id")
+
+    def reopen(self):
+        """
+        Открывает своё соединение в процессе, созданном fork: соединением SQLite
+        родителя пользоваться в дочернем процессе нельзя. Унаследованное соединение
+        не закрывается (это может снять блокировки родителя), а лишь не используется.
+        """
+        self._inherited = self.connection
+        self.connection = sqlite3.connect(self.name)
+
+    def journal(self, table: str, kind: str = None) -> StoreJournal:
+        return StoreJournal(self, table, kind)
+
+    def import_records(self, table: str, records, kind: str = None):
+        """Одной транзакцией переносит данные из старых json файлов (список или словарь)."""
+        journal = self.journal(table, kind)
+        for key, value in records.items() if isinstance(records, dict) else ((record, None) for record in records):
+            journal.write(key, value)
+        journal.flush()
+
+    def _stream(self, query: str, table: str, batch: int = 1000):
+        """
+        Построчно отдаёт результат запроса по страницам из batch строк таблицы table.
+        Чтение идёт через отдельное соединение, каждая страница - отдельным коротким
+        чтением: долгая транзакция чтения в режиме WAL не давала бы переносить
+        -wal файл в базу (checkpoint), и он рос бы всё время работы. Отдаются
+        только строки, которые уже были в таблице в начале чтения, так что
+        добавленные по ходу работы записи не выдаются повторно.
+        """
+        connection = sqlite3.connect(self.name)
+        try:
+            last = connection.execute(f"SELECT max(rowid) FROM {table}").fetchone()[0]
+            rowid = 0
+            while last is not None:
+                rows = connection.execute(query, (rowid, last, batch)).fetchall()
+                if not rows:
+                    return
+                for rowid, value in rows:
+                    yield value
+        finally:
+            connection.close()
+
+    def pending_links(self):
+        """Ссылки на треки без статуса или с ошибкой, которую нужно повторить."""
+        return self._stream(PENDING_LINKS, "page_links")
+
+    def pending_downloads(self):
+        """id треков в пределах РФ, которые ещё не загружены."""
+        return self._stream(PENDING_DOWNLOADS, "links")
+
+    def count(self, table: str, where: str = "") -> int:
+        return self.connection.execute(f"SELECT count(*) FROM {table} {where}").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -1,9 +1,57 @@
 import asyncio
+import heapq
+import itertools
 import json
 import random
+import signal
 import time
 import traceback
 import os
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+
+from channel import Channel, producer
+from concurrency import AdaptiveLimit
+from metrics import Metrics
+from persistence import load_json_data, save_json_data, wait_saved
+from profiler import Profiler
+from ratelimit import HOST_LIMITS
+from workers import WorkerPool
+
+try:
+    import aiohttp
+except ImportError:  # Для задач без сетевой части aiohttp не обязателен.
+    aiohttp = None
+
+
+# Маркер отсутствия данных у задачи (None может быть вполне законными данными).
+NO_DATA = object()
+
+# Этап без профилирования.
+NOT_PROFILED = nullcontext()
+
+
+def ignore_sigint():
+    """
+    Ctrl+C получают все процессы группы: дочерние процессы (пул prepare, исполнители)
+    его не обрабатывают, остановкой управляет основной процесс (AsyncTaskRuner.stop).
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class RetryTask(Exception):
+    """
+    Временная ошибка задачи: AsyncTaskRuner повторит задачу с теми же данными
+    через паузу (см. BaseTask.max_attempts).
+
+    delay - пауза до повтора в секундах (например из заголовка Retry-After),
+    None - экспоненциальная пауза с разбросом.
+    """
+
+    def __init__(self, *args, delay: float = None):
+        super().__init__(*args)
+        self.delay = delay
 
 
 def exist_or_create_path(path):
@@ -44,29 +92,110 @@ def save_by_exception(exception: Exception, from_path: str, to_path: str, file_n
     os.rename(os.path.join(from_path, file_name), os.path.join(new_path, file_name))
 
 
-def save_json_data(name: str, data):
+class Journal:
     """
-    Сохраняет данные в формате json (учтите что не всё можно сохранить без
-    написания специального класса или без предварительного переводжа данных
-    в строку или список)
+    Журнал изменений в формате JSON-lines (одна строка - одна запись [ключ, значение]).
+
+    Записи копятся в памяти и дописываются в конец файла методом flush, поэтому
+    стоимость сохранения пропорциональна количеству новых изменений, а не общему
+    объёму результатов. При чтении (replay) последнее значение ключа побеждает,
+    оборванная при аварии последняя строка пропускается.
     """
-    if name:
-        with open(name, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
 
+    def __init__(self, name: str):
+        self.name = name
+        self._records = []
+        self._tail_checked = False
 
-def load_json_data(name: str, default=None):
-    """
-    Читает данные из json файла.
+    def write(self, key, value=None):
+        """Добавляет запись в очередь на запись в файл."""
+        self._records.append((key, value))
 
-    name - имя файла.
-    default - передаваемое значение по умолчанию если файла нет или он не читается.
-    """
-    try:
-        with open(name) as f:
-            return json.load(f)
-    except:
-        return default
+    def flush(self):
+        """Дописывает накопленные записи в файл журнала."""
+        if not self._records:
+            return
+        lines = [(json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8') for record in self._records]
+        with open(self.name, 'ab+') as f:
+            if not self._tail_checked:
+                # Если прошлый запуск оборвался посреди строки - начинаем с новой.
+                self._tail_checked = True
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        lines.insert(0, b"\n")
+            f.writelines(lines)
+        self._records = []
+
+    def replay(self):
+        """Читает журнал и возвращает записи (ключ, значение) по порядку."""
+        try:
+            with open(self.name, 'rb') as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        continue
+                    yield key, value
+        except OSError:
+            return
+
+    def keys(self) -> set:
+        """Все ключи из журнала (для результатов хранящихся в множестве)."""
+        return {key for key, _ in self.replay()}
+
+    def items(self) -> dict:
+        """Итоговое состояние словаря после проигрывания журнала."""
+        return dict(self.replay())
+
+    def remove(self):
+        """Удаляет журнал: вызывается после того как полный снимок данных записан на диск."""
+        self._records = []
+        os.path.exists(self.name) and os.remove(self.name)
+
+
+class JournalSet(set):
+    """Множество, которое записывает каждый новый элемент в журнал."""
+
+    def __init__(self, journal: Journal, items=()):
+        super().__init__(items)
+        self.journal = journal
+
+    def add(self, item):
+        if item not in self:
+            self.journal.write(item)
+        super().add(item)
+
+
+class JournalDict(dict):
+    """Словарь, который записывает каждое присваивание значения в журнал."""
+
+    def __init__(self, journal: Journal, items=()):
+        super().__init__(items)
+        self.journal = journal
+
+    def __setitem__(self, key, value):
+        self.journal.write(key, value)
+        super().__setitem__(key, value)
+
+    def increment(self, key, delta: int = 1):
+        """
+        Прибавляет delta к значению key (нет значения - к 0). В процессах-исполнителях
+        передаётся в основной процесс как приращение, а не как итоговое значение.
+        """
+        self[key] = self.get(key, 0) + delta
+
+
+class JournalList(list):
+    """Список, который записывает каждый добавленный элемент в журнал."""
+
+    def __init__(self, journal: Journal, items=()):
+        super().__init__(items)
+        self.journal = journal
+
+    def append(self, item):
+        self.journal.write(item)
+        super().append(item)
 
 
 class BaseTask:
@@ -84,9 +213,17 @@ class BaseTask:
     последующего запуска функции, не включая данные которые передаются в
     реальном времени.
 
-    Метод: def append(self, data) - просто добавляет новые данные для вызова
-    вне очереди генерации, эти значения будут переданы на исполнение в первую
-    очередь.
+    Метод: async def put(self, data) - добавляет новые данные для вызова вне
+    очереди генерации, эти значения будут переданы на исполнение в первую
+    очередь. Данные хранятся в канале (channel.Channel) размером channel_size
+    (0 - без ограничения) в порядке FIFO или по приоритету channel_priority.
+    Если канал заполнен - вызвавшая задача ждёт пока место освободится, так
+    задачи-производители не убегают вперёд потребителя.
+
+    Метод: def append(self, data) - то же что и put, но без ожидания места.
+
+    Метод: async def emit(self, data) - передаёт данные (put) всем следующим
+    стадиям конвейера (self.outputs, заполняется pipeline.Pipeline).
 
     Метод: def save(self) - сохраняет данные из self.results на диск под
     именем файла self.name
@@ -95,23 +232,99 @@ class BaseTask:
     каждым запуском новой асинхронной задачи. Предназначена для логирования
     или сохранения статистики.
 
+    Метод: def error(self, exc) - задача сама обработала исключение (напечатала,
+    перенесла файл в папку ошибок...): вызов учитывает его в метриках ошибок.
+
+    Метод: def dead_letter(self, data, exc) - вызывается для данных, задача
+    с которыми так и не выполнилась за max_attempts попыток (см. RetryTask).
+
+    Метод: def stop(self) - вызывается раннером при остановке работы (Ctrl+C):
+    новые задачи больше не запускаются, выполняемые доделываются. Задачи,
+    которые ждут данных извне (например наблюдают за папкой), должны по
+    self.stopped завершиться.
+
     Метод: def exit(self) - выполняется перед самым выходом после абсолютно
     всех иных процедур, один раз. Возможность прибрать за собой или произвести
     какие-то дейцствия на последок.
+
+    Атрибут use_session = True - AsyncTaskRuner откроет для класса одну
+    долгоживущую aiohttp.ClientSession (self.session) перед стартом и закроет
+    её после exit(). Все запросы задачи должны идти через неё, тогда TCP и TLS
+    соединения переиспользуются. Дополнительные параметры сессии можно
+    передать через session_options.
+
+    Атрибут prepare - синхронная CPU-bound стадия обработки данных. Если она
+    задана (обязательно как @staticmethod или обычная функция модуля, чтобы её
+    можно было передать в другой процесс), AsyncTaskRuner выполняет её в пуле
+    процессов через run_in_executor, а в task попадает уже её результат. Данные
+    готовятся заранее: в работе держится до prefetch + 1 подготовленных значений.
+
+    Атрибут max_concurrency - сколько задач класса может выполняться
+    одновременно (None - ограничено только chunk_size раннера). Атрибут
+    weight - доля свободных мест, которую получает класс относительно других
+    классов при нехватке мест (взвешенная справедливая очередь).
+
+    Атрибуты requests_per_second, bytes_per_second - ограничение частоты
+    запросов и объёма ответов сессии к каждому хосту (см. ratelimit.py).
+    Ограничение общее для всех классов задач, обращающихся к одному хосту.
+
+    Атрибуты max_attempts, retry_delay, retry_max_delay - если task вызвала
+    исключение RetryTask, задача будет повторена, всего до max_attempts
+    попыток. Пауза перед повтором растёт вдвое с каждой попыткой начиная с
+    retry_delay секунд (но не больше retry_max_delay), к ней добавляется
+    случайный разброс, чтобы повторы не шли к серверу одновременно.
+
+    Атрибут shared_state - имена атрибутов (кроме results), которые task
+    меняет и изменения которых нужно вернуть в основной процесс, если задачи
+    выполняются в процессах-исполнителях (AsyncTaskRuner(workers=N), см.
+    workers.py). Контейнер вложенного объекта указывается через точку, например
+    "fetcher.validators". Данные для put/append/emit передаются всегда.
+
+    Атрибут idle - сколько задач класса сейчас ждут данных извне (например
+    новых файлов). Такие задачи, как и ждущие места в канале, не занимают места
+    раннера и не учитываются в лимитах класса; задача сама увеличивает idle на
+    время ожидания.
+
+    Атрибут profiler - profiler.Profiler, замеряющий этапы задачи (выбор данных,
+    logger, task, save), задаётся раннером (AsyncTaskRuner(profiler=...)).
     """
 
+    max_concurrency = None
+    weight = 1
+    channel_size = 0
+    channel_priority = None
+    use_session = False
+    session_options = None  # dict дополнительных параметров aiohttp.ClientSession
+    session = None
+    requests_per_second = None
+    bytes_per_second = None
+    prepare = None
+    prefetch = 0
+    executor = None
+    max_attempts = 5
+    retry_delay = 1
+    retry_max_delay = 5*60
+    shared_state = ()
+    dispatch = None  # Выполняет задачу в процессе-исполнителе: async dispatch(self, data).
+    profiler = None
+    on_error = None  # Учёт ошибок в метриках: on_error(exc), задаётся раннером.
+
     def __init__(self, *args, **kwargs):
         """
         Данный метод призван сформировать исходные данные для анализа и дальнейшей обработки их в методе data_generator
         """
         random.seed(time.time() + id(self))
         self._id = random.randint(0, 2**32 - 1)
-        self._data = []
+        self._data = Channel(self.channel_size, self.channel_priority)
+        self.outputs = self.__dict__.get("outputs", [])
         self._data_gen = None
         self._gen_is_empty = False
+        self._prepared = deque()
         self.results = self.__dict__.get("results", kwargs.get("results", []))
         self.name = self.__dict__.get("name", kwargs.get("name", f"{self.__class__.__name__}-{self._id}"))
         self._continue = True
+        self.idle = 0
+        self.stopped = False
         ...
 
     async def task(self, data):
@@ -125,6 +338,22 @@ class BaseTask:
         """Логгирует данные которые необходимо сохранять или распечатывает. Определяется пользователем."""
         ...
 
+    def error(self, exc: BaseException | str):
+        """
+        Задача сама обработала исключение exc - оно учитывается в метриках ошибок (если
+        они собираются). exc может быть и именем типа исключения.
+        """
+        if self.on_error is not None:
+            self.on_error(exc)
+
+    def dead_letter(self, data, exc: Exception):
+        """Задача с данными data не выполнилась за max_attempts попыток. Определяется пользователем."""
+        print(f"{self.__class__.__name__}: не удалось выполнить задачу за {self.max_attempts} попыток: {data} ({exc})")
+
+    def stop(self):
+        """Работа останавливается: задачи, ждущие данных извне, должны завершиться."""
+        self.stopped = True
+
     def exit(self):
         """
         Выполняется перед завершением работы. В этот момент пользователь может каким-то образом прибраться
@@ -145,8 +374,54 @@ class BaseTask:
     def append(self, data):
         """
         Добавляет данные для обработки их вне очереди если таковые появились в процессе выполнения задачи.
+        Ограничение размера канала не учитывается.
+        """
+        self._data.put_nowait(data)
+
+    async def put(self, data):
+        """
+        Добавляет данные для обработки их вне очереди, если канал заполнен - ждёт пока потребитель
+        заберёт данные из него.
+        """
+        await self._data.put(data)
+
+    async def emit(self, data):
+        """Передаёт данные следующим стадиям конвейера."""
+        for task in self.outputs:
+            await task.put(data)
+
+    async def open_session(self, limit: int, trace_configs: list = None):
         """
-        self._data.append(data)
+        Открывает общую для всех задач класса сессию. Размер пула соединений
+        определяется limit (как правило это chunk_size раннера), соединения
+        держатся в режиме keep-alive, DNS ответы кешируются.
+        trace_configs - aiohttp.TraceConfig для наблюдения за запросами сессии.
+        """
+        if not self.use_session or self.session is not None:
+            return
+        if self.requests_per_second or self.bytes_per_second:
+            trace_configs = [
+                *(trace_configs or []),
+                HOST_LIMITS.trace_config(self.requests_per_second, self.bytes_per_second),
+            ]
+        connector = aiohttp.TCPConnector(
+            ssl=False,
+            limit=limit,
+            limit_per_host=limit,
+            use_dns_cache=True,
+            ttl_dns_cache=5*60,
+            keepalive_timeout=60,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, raise_for_status=True, trace_configs=trace_configs,
+            **(self.session_options or {}),
+        )
+
+    async def close_session(self):
+        """Закрывает сессию открытую в open_session."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
     def save(self, name: str = None, data=None):
         """
@@ -156,39 +431,105 @@ class BaseTask:
             Если передать data - сохранит именно эти данные вместо self.results.
 
         Внутренняя логика процесса асинхронной загрузки всегда будет вызывать self.save() без параметров.
+        Если self.results ведёт журнал (JournalSet, JournalDict) - такой вызов лишь дописывает в
+        журнал изменения с момента прошлого сохранения.
         """
+        journal = getattr(self.results, "journal", None)
+        if name is None and data is None and journal is not None:
+            journal.flush()
+            return
         if name is None:
             name = self.name
         if data is None:
             data = self.results
         save_json_data(name, data)
 
-    @property
-    def new_task(self):
-        """Генерит новую задачу на выполнение с конкретными параметрами."""
+    def next_data(self):
+        """
+        Выбирает следующие данные на обработку: сначала добавленные через put или append,
+        затем из генератора. Если данных нет - возвращает NO_DATA.
+        """
         if self._data_gen is None:
             self._data_gen = self.data_generator()
 
         if self._data:
-             data = self._data.pop()
-        elif self._gen_is_empty:
-            return
-        else:
-            try:
-                data = next(self._data_gen)
-            except StopIteration:
-                self._gen_is_empty = True
-                return
-            except KeyboardInterrupt:
-                self._gen_is_empty = True
-                return
+            return self._data.get_nowait()
+        if self._gen_is_empty:
+            return NO_DATA
+        try:
+            return next(self._data_gen)
+        except StopIteration:
+            self._gen_is_empty = True
+        except KeyboardInterrupt:
+            self._gen_is_empty = True
+        return NO_DATA
+
+    def make_task(self, data, source=NO_DATA):
+        """
+        Оборачивает данные в функцию, которая создаёт корутину задачи (её можно вызвать
+        повторно для повтора задачи). source - исходные данные, если data получены из них
+        через prepare.
+        """
+        def task():
+            return self.run_task(data)
+        task.data = data if source is NO_DATA else source
+        return task
 
-        self.logger(data)
+    async def run_task(self, data):
+        """Выполняет задачу здесь или в процессе-исполнителе, если он задан."""
+        if self.dispatch is None:
+            return await self.task(data)
+        return await self.dispatch(self, data)
 
-        def task():
-            return self.task(data)
+    def profile(self, phase: str):
+        """Контекст замера этапа phase, если задан profiler."""
+        if self.profiler is None:
+            return NOT_PROFILED
+        return self.profiler.phase(self, phase)
+
+    def _new_prepared_task(self):
+        """
+        Версия new_task для классов с CPU-bound стадией prepare: данные заранее (с
+        запасом в self.prefetch штук) отправляются в пул процессов, а задача ждёт
+        готовый результат и передаёт его в self.task.
+        """
+        loop = asyncio.get_running_loop()
+        while len(self._prepared) <= self.prefetch:
+            with self.profile("next"):
+                data = self.next_data()
+            if data is NO_DATA:
+                break
+            with self.profile("logger"):
+                self.logger(data)
+            self._prepared.append((data, loop.run_in_executor(self.executor, self.prepare, data)))
+
+        if not self._prepared:
+            return
+        data, future = self._prepared.popleft()
+
+        async def task():
+            return await self.run_task(await future)
+        task.data = data
         return task
 
+    @property
+    def new_task(self):
+        """Генерит новую задачу на выполнение с конкретными параметрами."""
+        if self.prepare is not None and self.executor is not None:
+            return self._new_prepared_task()
+
+        with self.profile("next"):
+            data = self.next_data()
+        if data is NO_DATA:
+            return
+        with self.profile("logger"):
+            self.logger(data)
+        if self.prepare is not None:
+            with self.profile("prepare"):
+                prepared = self.prepare(data)
+            return self.make_task(prepared, source=data)
+        return self.make_task(data)
+
 
 class AsyncTaskRuner:
     """
@@ -204,9 +545,17 @@ class AsyncTaskRuner:
         """
         while True:
             await asyncio.sleep(self.time_to_save)
+            self.checkpoint(task_class)
+
+    def checkpoint(self, task_class: BaseTask):
+        """Сохраняет результаты класса задач, учитывая длительность сохранения в метриках."""
+        start = time.monotonic()
+        with task_class.profile("save"):
             task_class.save()
+        if self.metrics is not None:
+            self.metrics.on_checkpoint(task_class.__class__.__name__, time.monotonic() - start)
 
-    async def run_tasks_class_in_async_mode(self, tasks_gen, loop, dalay=0.1):  # data
+    async def run_tasks_class_in_async_mode(self, tasks_gen, loop):
         """
         Запускает любую асинхронную задачу из класса задачи использующую
         входные данные в режиме ограничения количества параллельно запущенных
@@ -215,78 +564,342 @@ class AsyncTaskRuner:
         Как только данные закончатся система дождётся завершения выполнения
         последней задачи и закончит работу сохранив все результаты.
 
+        Ожидание построено на asyncio.wait(..., return_when=FIRST_COMPLETED): как только
+        завершается хотя бы одна задача, её результат сразу же отдаётся наружу, а на
+        освободившееся место немедленно ставится следующая задача. Никаких фиксированных
+        пауз между проверками нет.
+
+        Задачи ждущие места в заполненном канале (await put) и ждущие данных извне
+        (BaseTask.idle) не занимают место: на время
+        ожидания вместо них можно запустить другие задачи, иначе производители могут занять
+        все места и потребитель не сможет освободить канал. Встав в ожидание, канал будит
+        цикл через self._wakeup. Так же цикл будится когда подходит время повтора задачи и
+        когда в пустой канал поступают данные (их могла добавить задача, которая ещё не завершилась).
+
         tasks_gen - генератор задачь который возвращает всё новые и новые задачи для выполнения.
+        Если генератор вернул None - новых задач пока нет, но они появятся после завершения
+        уже запущенных.
         loop = asyncio.new_event_loop() | asyncio.get_event_loop()
-        dalay = 0.1 - задержка между проверками статуса, выполняется только если в
-        цикле нет ни одной завершенной задачи.
         """
+        pending, gen_is_empty = set(), False
+        wakeup = None
 
-        def move_task():
-            task = tasks.pop()
-            if count < len(tasks):
-                tasks[count] = task
-
-        tasks, count, continue_task = [], 0, True
-
-        while continue_task:
-            continue_task = continue_task and bool(count)
-            if len(tasks) < self.chunk_size:
+        while True:
+            # Заполняем все свободные места новыми задачами.
+            while not gen_is_empty and len(pending) < self.chunk_size + self.blocked_tasks() + self.idle_tasks():
                 try:
-                    tasks.append(asyncio.ensure_future(next(tasks_gen)(), loop=loop))
+                    task = next(tasks_gen)
+                    if task is None:
+                        # Генератор сообщил что сейчас запускать нечего - ждём завершения задач.
+                        break
+                    pending.add(asyncio.ensure_future(task(), loop=loop))
                 except StopIteration:
-                    pass
+                    gen_is_empty = True
                 except KeyboardInterrupt:
                     return
 
-            if len(tasks) > 0:
+            if not pending and (gen_is_empty or not self.retries_pending()):
+                if wakeup is not None:
+                    wakeup.cancel()
+                return
+
+            if wakeup is None or wakeup.done():
+                self._wakeup.clear()
+                wakeup = asyncio.ensure_future(self._wakeup.wait(), loop=loop)
+            try:
+                done, pending = await asyncio.wait(pending | {wakeup}, return_when=asyncio.FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                return
+            done.discard(wakeup)
+            pending.discard(wakeup)
+
+            for task in done:
                 try:
-                    if tasks[count].done():
-                        yield tasks[count].result()
-                        move_task()
-                    else:
-                        count += 1
+                    result = task.result()
                 except KeyboardInterrupt:
                     return
                 except Exception as exc:
                     print('Возникла проблема при выполнении задачи, требуется логирование.', exc)
-                    traceback.print_exc()
-                    move_task()
-
-                continue_task = True
-
-            if count >= len(tasks):
-                count = 0
-                await asyncio.sleep(dalay)
-
-
-    def __init__(self, chunk_size: int = 20, time_to_save: int = 5*60):
+                    traceback.print_exception(exc)
+                    continue
+                yield result
+
+    def __init__(
+            self,
+            chunk_size: int = 20,
+            time_to_save: int = 5*60,
+            processes: int = None,
+            adaptive: bool = False,
+            prefer_downstream: bool = False,
+            prefer_critical_path: bool = False,
+            workers: int = 0,
+            metrics: Metrics = None,
+            profiler: Profiler = None,
+    ):
         """
         chunk_size - Количество одновременно запущенных задач
         time_to_save - время автоматического сохранения результатов
+        processes - количество процессов для CPU-bound стадий prepare (None - по числу ядер).
+        adaptive - подбирать количество одновременных задач для каждого класса автоматически
+        (AIMD по задержке и ошибкам удалённой стороны), chunk_size остаётся общим пределом.
+        prefer_downstream - отдавать свободные места в первую очередь последним классам списка
+        задач (следующим стадиям конвейера), чтобы промежуточные очереди не разрастались.
+        prefer_critical_path - для конвейера (run с graph) отдавать свободные места в первую
+        очередь стадиям на самом долгом пути графа (по среднему времени выполнения задач).
+        workers - количество процессов-исполнителей задач (см. workers.py), 0 - все задачи
+        выполняются в основном процессе. chunk_size остаётся общим пределом задач.
+        metrics - сборщик метрик (см. metrics.py): время выполнения задач, очереди, ошибки,
+        сохранения и задержка event loop. None - метрики не собираются.
+        profiler - профилировщик этапов задач (см. profiler.py): время и CPU выбора данных,
+        logger, task, обработки результата и save, блокировки event loop. Итоги выводятся
+        в конце работы.
         """
         self.chunk_size = chunk_size
         self.time_to_save = time_to_save
+        self.processes = processes
+        self.adaptive = adaptive
+        self.prefer_downstream = prefer_downstream
+        self.prefer_critical_path = prefer_critical_path
+        self.workers = workers
+        self.metrics = metrics
+        self.profiler = profiler
+        self.pool = None
+        self.graph = None  # BaseTask -> список следующих стадий, если задачи образуют конвейер
+        self.upstream = {}  # BaseTask -> список предыдущих стадий
+        self.finished = set()  # Стадии конвейера, которые закончили работу
+        self._cost = {}  # BaseTask -> среднее время выполнения задачи
+        self.limits = {}  # BaseTask -> AdaptiveLimit
+        self._in_flight = {}  # BaseTask -> количество выполняемых задач
+        self.channels = {}  # BaseTask -> Channel
+        self._retries = {}  # BaseTask -> куча (время повтора, номер, задача, номер попытки)
+        self._retry_numbers = itertools.count()
+        self._wakeup = asyncio.Event()
+        self.stopping = False
+        self._tasks = []
+
+    def stop(self):
+        """
+        Остановка по Ctrl+C: новые задачи не запускаются, выполняемые доделываются, затем
+        результаты сохраняются как при обычном завершении. Повторный Ctrl+C прерывает
+        работу сразу.
+        """
+        print("--- Остановка: доделываются выполняемые задачи, повторный Ctrl+C прервёт работу.")
+        self.stopping = True
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGINT)
+        for task in self._tasks:
+            task.stop()
+        self._wakeup.set()
+
+    def blocked_tasks(self) -> int:
+        """Количество задач ждущих места в заполненных каналах."""
+        return sum(sum(channel.blocked.values()) for channel in self.channels.values())
+
+    def idle_tasks(self) -> int:
+        """Количество задач ждущих данных извне (BaseTask.idle)."""
+        return sum(task_class.idle for task_class in self.channels)
+
+    def channel_stats(self) -> dict:
+        """Метрики каналов: глубина очереди и время ожидания производителей."""
+        return {task.__class__.__name__: channel.stats() for task, channel in self.channels.items()}
+
+    def concurrency_limits(self) -> dict:
+        """Текущие лимиты одновременных задач по классам задач."""
+        return {task.__class__.__name__: limit.value for task, limit in self.limits.items()}
+
+    def has_free_slot(self, task_class: BaseTask) -> bool:
+        """
+        Может ли класс задач запустить ещё одну задачу в рамках своих лимитов. Новые задачи
+        класса не запускаются, пока его задачи ждут места в канале следующей стадии.
+        """
+        if any(channel.blocked[task_class] for channel in self.channels.values()):
+            return False
+        in_flight = self._in_flight.get(task_class, 0) - task_class.idle
+        if task_class.max_concurrency is not None and in_flight >= task_class.max_concurrency:
+            return False
+        limit = self.limits.get(task_class)
+        return limit is None or in_flight < limit.value
+
+    def track(self, task_class: BaseTask, task, attempt: int = 1):
+        """
+        Учитывает задачу как выполняемую классом task_class до её завершения и
+        сообщает лимиту класса время её выполнения (задачам с сессией задержку сообщают
+        их запросы, см. concurrency.limit_trace_config). Если задача вызвала RetryTask -
+        ставит её в очередь повторов. attempt - номер попытки.
+        """
+        self._in_flight[task_class] = self._in_flight.get(task_class, 0) + 1
+        limit = self.limits.get(task_class)
 
+        async def tracked():
+            producer.set(task_class)
+            start = time.monotonic()
+            try:
+                if self.profiler is None:
+                    return await task()
+                return await self.profiler.timed(task_class, task())
+            except RetryTask as exc:
+                if self.metrics is not None:
+                    self.metrics.on_error(task_class.__class__.__name__, exc)
+                self.retry(task_class, task, attempt, exc)
+            except Exception as exc:
+                if self.metrics is not None:
+                    self.metrics.on_error(task_class.__class__.__name__, exc)
+                raise
+            finally:
+                with task_class.profile("result"):
+                    self._in_flight[task_class] -= 1
+                    latency = time.monotonic() - start
+                    self._cost[task_class] = 0.9 * self._cost.get(task_class, latency) + 0.1 * latency
+                    if limit is not None and not task_class.use_session:
+                        # Задачам с сессией задержку сообщают сами запросы (AdaptiveLimit.trace_config).
+                        limit.on_latency(latency)
+                    if self.metrics is not None:
+                        self.metrics.on_complete(task_class.__class__.__name__, latency)
+        return tracked
+
+    def update_metrics(self, tasks: list[BaseTask]):
+        """Обновляет мгновенные значения метрик: выполняемые задачи, очереди, повторы."""
+        for task_class in tasks:
+            metrics = self.metrics.task(task_class.__class__.__name__)
+            metrics.in_flight = self._in_flight.get(task_class, 0)
+            metrics.queue_depth = len(task_class._data)
+            metrics.retries_pending = len(self._retries.get(task_class, ()))
+
+    def retry(self, task_class: BaseTask, task, attempt: int, exc: RetryTask):
+        """
+        Ставит задачу в очередь повторов класса. Пауза - exc.delay, либо растёт вдвое с
+        каждой попыткой (retry_delay, 2*retry_delay, ... не больше retry_max_delay) и
+        выбирается случайно между половиной и полной величиной. После max_attempts
+        попыток данные задачи передаются в task_class.dead_letter.
+        """
+        if attempt >= task_class.max_attempts:
+            if self.metrics is not None:
+                self.metrics.on_dead_letter(task_class.__class__.__name__)
+            task_class.dead_letter(getattr(task, "data", None), exc)
+            return
+        delay = exc.delay
+        if delay is None:
+            delay = min(task_class.retry_max_delay, task_class.retry_delay * 2 ** (attempt - 1))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        heapq.heappush(
+            self._retries.setdefault(task_class, []),
+            (time.monotonic() + delay, next(self._retry_numbers), task, attempt + 1),
+        )
+        asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+
+    def retries_pending(self) -> int:
+        """Количество задач ждущих повтора."""
+        return sum(len(retries) for retries in self._retries.values())
+
+    def next_retry(self, task_class: BaseTask):
+        """Задача класса, время повтора которой наступило, и номер её попытки или (None, 0)."""
+        retries = self._retries.get(task_class)
+        if retries and retries[0][0] <= time.monotonic():
+            _, _, task, attempt = heapq.heappop(retries)
+            return task, attempt
+        return None, 0
+
+    def is_drained(self, task_class: BaseTask) -> bool:
+        """
+        Стадия конвейера закончила работу: все предыдущие стадии закончили, её генератор
+        исчерпан, канал пуст и ни одна её задача не выполняется.
+        """
+        return (
+            task_class._gen_is_empty
+            and not task_class._data
+            and not task_class._prepared
+            and not self._in_flight.get(task_class)
+            and not self._retries.get(task_class)
+            and all(upstream in self.finished for upstream in self.upstream[task_class])
+        )
+
+    def finish_stage(self, task_class: BaseTask):
+        """Отмечает конец потока данных стадии: закрывает её канал и сохраняет результаты."""
+        self.finished.add(task_class)
+        task_class._data.close()
+        self.checkpoint(task_class)
+        print(f"--- Стадия {task_class.__class__.__name__} завершена.")
+
+    def critical_path(self, task_list: list[BaseTask]) -> set:
+        """
+        Стадии на самом долгом пути графа конвейера. Длина пути - сумма средних времён
+        выполнения задач его стадий (пока время неизвестно - 1 сек.). task_list должен
+        быть упорядочен так, чтобы предыдущие стадии шли раньше следующих.
+        """
+        head, tail = {}, {}
+        for task_class in task_list:
+            cost = self._cost.get(task_class, 1.)
+            head[task_class] = cost + max((head[up] for up in self.upstream[task_class]), default=0.)
+        for task_class in reversed(task_list):
+            cost = self._cost.get(task_class, 1.)
+            tail[task_class] = cost + max((tail[down] for down in self.graph[task_class]), default=0.)
+        length = {
+            task_class: head[task_class] + tail[task_class] - self._cost.get(task_class, 1.)
+            for task_class in task_list
+        }
+        longest = max(length.values())
+        return {task_class for task_class, value in length.items() if value >= longest * (1 - 1e-9)}
 
     def get_task_from_tasks_list(self, task_list: list[BaseTask]):
         """
-        Перебирает по кругу доступные задачи среди переданного списка классов и если ни один класс не способен
-        сгенерировать новую задачу - завершает процесс.
+        Выбирает класс для следующей задачи по взвешенной справедливой очереди: у каждого
+        класса есть виртуальное время, которое при запуске его задачи растёт на 1 / weight,
+        и место достаётся классу с наименьшим виртуальным временем, у которого есть данные
+        и не исчерпан лимит. При prefer_critical_path вперёд идут стадии критического пути,
+        при prefer_downstream - последние классы списка. Классы упёршиеся в свой лимит
+        пропускаются.
+
+        Если задачи образуют конвейер (self.graph), то стадия у которой больше нет и не
+        появится данных сразу завершается и больше не опрашивается, а работа заканчивается
+        как только завершены все стадии.
+
+        Задачи ждущие повтора (RetryTask) запускаются раньше новых задач своего класса, как
+        только подойдёт их время.
+
+        Если запускать нечего, но задачи ещё выполняются (они могут добавить данные через
+        append или упираются в лимит) или ждут повтора - возвращает None (надо дождаться
+        завершения задач или времени повтора). Иначе завершает процесс. После stop
+        новые задачи и повторы не выдаются.
         """
-        index = errors = 0
-        max_index = len(task_list)
+        order = {task_class: index for index, task_class in enumerate(task_list)}
+        finish = dict.fromkeys(task_list, 0.)
+        virtual_time = 0.
+        critical = set()
+
+        def key(task_class):
+            return (
+                task_class not in critical,
+                -order[task_class] if self.prefer_downstream else 0,
+                finish[task_class],
+                order[task_class],
+            )
+
         while True:
-            task = task_list[index].new_task
-            if task:
-                errors = 0
-                yield task
-            else:
-                errors += 1
-            index = (index + 1) % max_index
-            if errors >= max_index:
+            active = [task_class for task_class in task_list if task_class not in self.finished]
+            if not active or self.stopping:
                 return
-
-    async def main(self, loop, tasks: list[BaseTask]):
+            if self.graph is not None and self.prefer_critical_path:
+                critical = self.critical_path(task_list)
+            for task_class in sorted(active, key=key):
+                if not self.has_free_slot(task_class):
+                    continue
+                task, attempt = self.next_retry(task_class)
+                if task is None:
+                    task, attempt = task_class.new_task, 1
+                if task:
+                    break
+                if self.graph is not None and self.is_drained(task_class):
+                    self.finish_stage(task_class)
+            else:
+                if not any(self._in_flight.values()) and not self.retries_pending():
+                    return
+                yield None
+                continue
+            # Простаивавший класс не получает "накопленного" права занять все места сразу.
+            virtual_time = max(finish[task_class], virtual_time)
+            finish[task_class] = virtual_time + 1 / task_class.weight
+            yield self.track(task_class, task, attempt)
+
+    async def main(self, loop, tasks: list[BaseTask], graph: dict = None):
         if self.chunk_size > 1:
             print('Скрипт запущен запущен в асинхронном режиме. Потоков:', self.chunk_size)
         else:
@@ -294,7 +907,51 @@ class AsyncTaskRuner:
 
         count = 0
         start_time = chunk_time = time.time()
-
+        self._tasks = tasks
+        self.stopping = False
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.stop)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows или не главный поток: Ctrl+C прерывает работу как обычно.
+
+        if self.adaptive:
+            self.limits = {task: AdaptiveLimit(self.chunk_size) for task in tasks}
+        self.channels = {task: task._data for task in tasks}
+        for task in tasks:
+            task.profiler = self.profiler
+        self.graph = graph
+        self.upstream = {task: [] for task in tasks}
+        for task, downstream in (graph or {}).items():
+            for next_task in downstream:
+                self.upstream[next_task].append(task)
+        self.finished = set()
+        for channel in self.channels.values():
+            channel.on_block = self._wakeup.set
+            channel.on_put = self._wakeup.set
+        if self.pool is not None:
+            # Задачи выполняются в процессах-исполнителях, сессии открываются там же.
+            self.pool.limits = self.limits
+            self.pool.start()
+            for task in tasks:
+                task.dispatch = self.pool.run
+        else:
+            for task in tasks:
+                limit = self.limits.get(task)
+                trace_configs = [limit.trace_config()] if limit and task.use_session else None
+                await task.open_session(self.chunk_size, trace_configs=trace_configs)
+
+        executor = None
+        if any(task.prepare is not None for task in tasks):
+            # И при workers prepare выполняется здесь: исполнителям уходят подготовленные данные.
+            executor = ProcessPoolExecutor(max_workers=self.processes, initializer=ignore_sigint)
+            for task in tasks:
+                task.executor = executor
+
+        if self.metrics is not None:
+            for task in tasks:
+                task.on_error = lambda exc, name=task.__class__.__name__: self.metrics.on_error(name, exc)
+            self.metrics.refresh = lambda: self.update_metrics(tasks)
+            await self.metrics.start()
         if self.time_to_save:
             save_by_tyme_tasks = [asyncio.create_task(self.save_result_by_time(task)) for task in tasks]
         async for _ in self.run_tasks_class_in_async_mode(
@@ -307,18 +964,52 @@ class AsyncTaskRuner:
                 time_left = round(time.time() - start_time, 3)
                 chunk_time = round(time.time() - chunk_time, 3)
                 print(f"--- Время итерации: {chunk_time} сек. Прошло: {time_left} сек.")
+                if self.limits:
+                    print(f"--- Лимиты задач: {self.concurrency_limits()}")
+                if any(channel.maxsize for channel in self.channels.values()):
+                    print(f"--- Каналы: {self.channel_stats()}")
+                if HOST_LIMITS.stats():
+                    print(f"--- Ограничения хостов: {HOST_LIMITS.stats()}")
+                if self.retries_pending():
+                    print(f"--- Ждут повтора: {self.retries_pending()}")
                 chunk_time = time.time()
 
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (NotImplementedError, RuntimeError):
+            pass
+        if self.pool is not None:
+            self.pool.close()
         # когда все посчитано ещё раз, на всякий случай записываем результат.
         for task in tasks:
-            task.save()
+            self.checkpoint(task)
         if self.time_to_save:
             for task in save_by_tyme_tasks:
                 task.cancel()
+        if executor is not None:
+            executor.shutdown()
+        # exit() удаляет промежуточные файлы - отложенные записи в них должны завершиться раньше.
+        wait_saved()
         for task in tasks:
             task.exit()
+        wait_saved()
+        for task in tasks:
+            await task.close_session()
+        if self.metrics is not None:
+            await self.metrics.stop()
+        if self.profiler is not None:
+            self.profiler.report()
 
-    def run(self, tasks: list[BaseTask]):
+    def run(self, tasks: list[BaseTask], graph: dict = None):
+        """
+        tasks - список задач.
+        graph - если задачи образуют конвейер: словарь задача -> список следующих стадий,
+        в которые она передаёт данные (см. pipeline.Pipeline). Задачи должны идти в
+        порядке стадий, данные стадии могут поступать только от предыдущих стадий графа.
+        """
+        if self.workers:
+            # Процессы-исполнители создаются fork-ом, до запуска event loop и открытия сессий.
+            self.pool = WorkerPool(tasks, self.workers, self.chunk_size, adaptive=self.adaptive)
         loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.main(loop, tasks))
+        loop.run_until_complete(self.main(loop, tasks, graph))
         loop.close()
@@ -1,16 +1,51 @@
+import asyncio
+import itertools
 import traceback
 import bz2
 import gzip
+import zlib
 import gpxpy
 import json
-from math import atan2, pi
+from math import pi
 import aiohttp
 import os
 
-from support import AsyncTaskRuner, load_json_data, BaseTask, save_by_exception, exist_or_create_path, save_json_data
+from discovery import DirectoryScanner
+from gpx_points import concat_columns, points_json, segment_columns
+from persistence import wait_saved
+from state_store import StateStore
+from support import (
+    AsyncTaskRuner, load_json_data, BaseTask, save_by_exception, exist_or_create_path, save_json_data, Journal,
+    JournalDict,
+)
 
 
 class UploadGpxFile(BaseTask):
+    """
+    Заливает треки из папки output/ на сервер.
+
+    Если batch_size больше 1 - треки заливаются пачками: генератор группирует до
+    batch_size файлов общим размером до batch_bytes, пачка разбивается на запросы
+    не больше batch_points точек. Тело запроса - json список треков, сжатый gzip
+    (Content-Encoding: gzip), в ответе 201 - json словарь id трека -> количество
+    принятых точек, по нему каждый файл переносится в good/ или в error/url/.
+
+    Тело запроса не собирается целиком: точки трека хранятся столбцами NumPy и
+    кодируются в json частями по points_chunk точек прямо во время отправки
+    (chunked transfer encoding), пачка сжимается так же по частям.
+
+    Новые файлы находит DirectoryScanner (см. discovery.py). Файлы читаются и
+    распаковываются в памяти в prepare, в пуле процессов: следующие prefetch
+    файлов читаются и разбираются заранее, пока идёт заливка, а event loop не ждёт
+    диска. Сжатые файлы на диске не распаковываются и переносятся как есть.
+
+    С watch задача не завершается, когда файлы кончились: одна задача-наблюдатель
+    (watch_files) раз в watch_interval секунд забирает новые файлы (с watchdog - по
+    событиям файловой системы) и передаёт их на заливку через append. Наблюдатель
+    не занимает места раннера (BaseTask.idle) и работает до остановки по Ctrl+C,
+    после чего раннер доделывает начатые заливки и сохраняет описания как обычно.
+    """
+    use_session = True
     RAD_TO_GRAD = 180 / pi
     BASE_PATH = "output/"
     GOOD_PATH = "good/"
@@ -18,8 +53,23 @@ class UploadGpxFile(BaseTask):
     ERROR_PATH = "error/"
     ERROR_URL_PATH = "error/url/"
     ERROR_GPX_PATH = "error/gpx/"
+    # Сколько файлов разбирать в пуле процессов заранее, пока идёт заливка.
+    prefetch = os.cpu_count() or 1
+    # Пакетная заливка: треков в пачке (1 - по одному), размер файлов и точек в пачке.
+    batch_size = int(os.getenv("UPLOAD_BATCH", 1))
+    batch_bytes = 16 * 2**20
+    batch_points = 200000
+    points_chunk = 2000
+    # Следить ли за output/ после того как файлы кончились и как часто забирать новые файлы.
+    watch = os.getenv("UPLOAD_WATCH", "False") == "True"
+    watch_interval = 1.
+    shared_state = ("_in_work", "_deleted", "_continue", "_count_good", "_count_points")
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, store: StateStore = None, **kwargs):
+        """
+        store - хранилище состояния (StateStore), если передано - описания треков
+        пишутся в него, а не в description.json.
+        """
         exist_or_create_path(self.GOOD_PATH)
         exist_or_create_path(self.ERROR_PATH)
         exist_or_create_path(self.ERROR_GPX_PATH)
@@ -27,9 +77,19 @@ class UploadGpxFile(BaseTask):
         self.name_delete = "deleted_files.json"
         self.name = "new_description.json"
         self.name_full_dict = "description.json"
-        self.results_for_search = load_json_data(self.name_full_dict, {}) | load_json_data(self.name, {})
-        self.results = {}
+        self.store = store
+        if store is None:
+            journal = Journal("new_description.jsonl")
+            self.results_for_search = (
+                load_json_data(self.name_full_dict, {}) | load_json_data(self.name, {}) | journal.items()
+            )
+        else:
+            journal = store.journal("descriptions")
+            self.results_for_search = {}
+        self.results = JournalDict(journal)
         self._deleted = load_json_data(self.name_delete, [])
+        self._in_work = set()  # id треков которые уже выданы генератором, но ещё не залиты.
+        self._scanner = None
 
         # Пока True - данные для обработки есть.
         # Как только станет False - больше обрабатывать нечего.
@@ -41,150 +101,305 @@ class UploadGpxFile(BaseTask):
         super().__init__(*args, **kwargs)
 
     def source_list(self):
-        gpx_files = set(os.listdir(self.BASE_PATH))
-        paths = []
-        for gpx_file in gpx_files:
-            if os.path.isfile(self.BASE_PATH + gpx_file) and ".gpx" in gpx_file:
-                paths.append(gpx_file)
-        return paths
-
-    def load_file(self, file: str) -> [str, str]:
-        base_path_file = os.path.join(self.BASE_PATH, file)
-        if not os.path.exists(base_path_file):
-            return None, file
-        if file.endswith(".gpx"):
+        """Новые GPX файлы в output/, которые ещё не выдавались."""
+        if self._scanner is None:
+            self._scanner = DirectoryScanner(self.BASE_PATH, match=lambda name: ".gpx" in name, watch=self.watch)
+        return self._scanner.scan()
+
+    @classmethod
+    def load_file(cls, file: str) -> bytes | None:
+        """Содержимое GPX файла, сжатые .bz2/.gz распаковываются в памяти. None - файла нет или формат не тот."""
+        base_path_file = os.path.join(cls.BASE_PATH, file)
+        try:
             with open(base_path_file, 'rb') as f:
                 data = f.read()
-            return data, file
+        except OSError:
+            return None
+        if file.endswith(".gpx"):
+            return data
         if file.endswith(".bz2"):
-            with bz2.open(base_path_file, 'rb') as f:
-                data = f.read()
-            with open(base_path_file[:-4], 'wb') as f:
-                f.write(data)
-            os.remove(base_path_file)
-            return data, file[:-4]
+            return bz2.decompress(data)
         if file.endswith(".gz"):
-            with gzip.open(self.BASE_PATH + file, 'rb') as f:
-                data = f.read()
-            with open(base_path_file[:-3], 'wb') as f:
-                f.write(data)
-                os.remove(base_path_file)
-            return data, file[:-3]
-        return None, file
+            return gzip.decompress(data)
+        return None
 
-    def moov_error_file(self, file: str):
-        os.rename(self.BASE_PATH + file, self.ERROR_PATH + file)
+    @classmethod
+    def read_file(cls, file: str) -> bytes | None:
+        """load_file для prepare_file: ошибка чтения - как отсутствие данных."""
+        try:
+            return cls.load_file(file)
+        except Exception as exc:
+            print(f"Не удалось прочитать {file}: {exc}")
+            return None
+
+    @classmethod
+    def moov_error_file(cls, file: str):
+        os.rename(cls.BASE_PATH + file, cls.ERROR_PATH + file)
 
     def logger(self, data):
         if self._count_good == 1000:
             print(f"Всего загружено в БД: {self._count_points} точек.")
             self._count_good = 0
 
+    async def run_task(self, data):
+        """Задача-наблюдатель (data is None) всегда выполняется в основном процессе, где живёт DirectoryScanner."""
+        if data is None:
+            return await self.watch_files()
+        return await super().run_task(data)
+
+    async def watch_files(self):
+        """Режим watch: пока работа не остановлена (stop), передаёт на заливку новые файлы из output/."""
+        self.idle += 1
+        try:
+            while not self.stopped:
+                await asyncio.sleep(self.watch_interval)
+                if self.stopped:
+                    return
+                for data in self.file_groups():
+                    self.append(data)
+        finally:
+            self.idle -= 1
+
     async def task(self, data):
-        payload, file_name = data
-        base_url = os.getenv("URL")
-        auth = os.getenv("BASIC_AUTH_GPS")
-        url = base_url + "<special method name>/"
+        if isinstance(data, list):
+            await self.task_batch(data)
+            return
+        track, file_name, track_names, _ = data
+        track_id = file_name.split(".gpx")[0]
+        try:
+            if track is None:
+                return
+            self.results[track_id] = track_names
+            await self.upload(track, file_name)
+        finally:
+            self._in_work.discard(track_id)
+
+    async def task_batch(self, data: list):
+        """Заливает пачку треков запросами не больше batch_points точек."""
+        try:
+            batch, batch_points = [], 0
+            for track, file_name, track_names, points in data:
+                if track is None:
+                    continue
+                self.results[file_name.split(".gpx")[0]] = track_names
+                if batch and batch_points + points > self.batch_points:
+                    await self.upload_batch(batch)
+                    batch, batch_points = [], 0
+                batch.append((track, file_name))
+                batch_points += points
+            if batch:
+                await self.upload_batch(batch)
+        finally:
+            for _, file_name, _, _ in data:
+                self._in_work.discard(file_name.split(".gpx")[0])
 
-        headers = {
+    @staticmethod
+    def headers() -> dict:
+        return {
             "Content-Type": "application/json",
-            "Authorization": auth
+            "Authorization": os.getenv("BASIC_AUTH_GPS")
         }
+
+    def uploaded(self, file_name: str, points: int) -> bool:
+        """Сервер принял points точек трека из file_name: файл убирается из output/."""
+        if not points:
+            return False
+        self._count_points += points
+        self._continue = True
+        if os.getenv("SAVE_MODE", True) == "False":
+            os.remove(self.BASE_PATH + file_name)
+            self._deleted.append(file_name)
+        else:
+            os.rename(self.BASE_PATH + file_name, self.GOOD_PATH + file_name)
+        return True
+
+    @classmethod
+    def track_json(cls, track: dict):
+        """Части json трека {"id": ..., "points": [...]}, точки кодируются по points_chunk штук."""
+        yield f'{{"id": {track["id"]}, "points": ['
+        for index, fragment in enumerate(points_json(track["columns"], cls.points_chunk)):
+            yield fragment if not index else ", " + fragment
+        yield "]}"
+
+    @classmethod
+    async def track_body(cls, track: dict):
+        """Тело запроса с одним треком."""
+        for fragment in cls.track_json(track):
+            yield fragment.encode("utf-8")
+
+    @classmethod
+    async def batch_body(cls, batch: list):
+        """Тело запроса с пачкой треков: json список, сжатый gzip по частям."""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for index, (track, _) in enumerate(batch):
+            fragments = cls.track_json(track)
+            if not index:
+                fragments = itertools.chain("[", fragments)
+            else:
+                fragments = itertools.chain(",", fragments)
+            for fragment in fragments:
+                chunk = compressor.compress(fragment.encode("utf-8"))
+                if chunk:
+                    yield chunk
+        yield compressor.compress(b"]") + compressor.flush()
+
+    async def upload(self, track: dict, file_name: str):
+        url = os.getenv("URL") + "<special method name>/"
+        data = self.track_body(track)
         try:
             timeout = aiohttp.ClientTimeout(total=24*60*60)
-            async with aiohttp.ClientSession(
-                    connector=aiohttp.TCPConnector(ssl=False),
-                    raise_for_status=True,
-            ) as session:
-                async with session.post(url, headers=headers, data=payload, timeout=timeout) as resp:
-                    if resp.status == 201:
-                        self._count_good += 1
-                        content = int(await resp.content.read())
-                        if content:
-                            self._count_points += int(content)
-                            self._continue = True
-                            if os.getenv("SAVE_MODE", True) == "False":
-                                os.remove(self.BASE_PATH + file_name)
-                                self._deleted.append(file_name)
-                            else:
-                                os.rename(self.BASE_PATH + file_name, self.GOOD_PATH + file_name)
-                            return
+            async with self.session.post(url, headers=self.headers(), data=data, timeout=timeout) as resp:
+                if resp.status == 201:
+                    self._count_good += 1
+                    if self.uploaded(file_name, int(await resp.content.read())):
+                        return
         except KeyboardInterrupt:
             self._continue = False
             return
         except Exception as exc:
             print(exc)
             traceback.print_exc()
+            self.error(exc)
             save_by_exception(exc, self.BASE_PATH, self.ERROR_PATH, file_name)
             return
         # Исключения не возникло, но что-то пошло не так.
         os.rename(self.BASE_PATH + file_name, self.ERROR_URL_PATH + file_name)
 
+    async def upload_batch(self, batch: list):
+        """
+        Заливает пачку треков [(track, file_name), ...] одним сжатым запросом. Каждый
+        трек, количество точек которого сервер не вернул, переносится в error/url/.
+        """
+        url = os.getenv("URL") + "<special batch method name>/"
+        body = self.batch_body(batch)
+        headers = {**self.headers(), "Content-Encoding": "gzip"}
+        accepted = {}
+        try:
+            timeout = aiohttp.ClientTimeout(total=24*60*60)
+            async with self.session.post(url, headers=headers, data=body, timeout=timeout) as resp:
+                if resp.status == 201:
+                    accepted = json.loads(await resp.content.read())
+        except KeyboardInterrupt:
+            self._continue = False
+            return
+        except Exception as exc:
+            print(exc)
+            traceback.print_exc()
+            self.error(exc)
+            for _, file_name in batch:
+                save_by_exception(exc, self.BASE_PATH, self.ERROR_PATH, file_name)
+            return
+        for _, file_name in batch:
+            points = accepted.get(file_name.split(".gpx")[0])
+            if self.uploaded(file_name, int(points or 0)):
+                self._count_good += 1
+            else:
+                os.rename(self.BASE_PATH + file_name, self.ERROR_URL_PATH + file_name)
+
     def save(self, name: str = None, data=None):
         super().save(name=name, data=data)
         super().save(self.name_delete, self._deleted)
 
+    def new_files(self):
+        """Новые файлы, треки которых сейчас не в работе."""
+        for file in self.source_list():
+            track_id = file.split(".gpx")[0]
+            if track_id in self._in_work:
+                continue
+            self._in_work.add(track_id)
+            yield file
+
+    def file_size(self, file: str) -> int:
+        try:
+            return os.path.getsize(self.BASE_PATH + file)
+        except OSError:
+            return 0
+
+    def file_groups(self):
+        """Новые файлы по одному или пачками (batch_size, batch_bytes - по размеру файлов на диске)."""
+        batch, batch_bytes = [], 0
+        for file in self.new_files():
+            if self.batch_size <= 1:
+                yield file
+                continue
+            size = self.file_size(file)
+            if batch and batch_bytes + size > self.batch_bytes:
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(file)
+            batch_bytes += size
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch, batch_bytes = [], 0
+        if batch:
+            yield batch
+
     def data_generator(self):
+        """
+        Файлы из output/ по одному или пачками (file_groups). С watch после этого
+        выдаётся None - задача-наблюдатель (watch_files).
+        """
         while self._continue:
             self._continue = False
-            files = self.source_list()
-            for file in files:
-                data, file = self.load_file(file)
-                if data is None:
-                    self.moov_error_file(file)
-                    continue
+            yield from self.file_groups()
+        if self.watch:
+            yield None
 
-                track_id = file.split(".gpx")[0]
-                if not track_id.isdigit():
-                    self.moov_error_file(file)
-                    continue
+    @staticmethod
+    def prepare(data: str | list | None):
+        """
+        Подготовка файла (prepare_file) или пачки файлов - списка результатов prepare_file.
+        None (задача-наблюдатель) передаётся как есть.
+        """
+        if data is None:
+            return None
+        if isinstance(data, list):
+            return [UploadGpxFile.prepare_file(file) for file in data]
+        return UploadGpxFile.prepare_file(data)
 
-                try:
-                    gpx = gpxpy.parse(data)
-                except KeyboardInterrupt:
-                    return
-                except Exception as exc:
-                    print(exc)
-                    traceback.print_exc()
-                    # save_by_exception сама рассортирует различные ошибки по папкам.
-                    save_by_exception(exc, self.BASE_PATH, self.ERROR_GPX_PATH, file)
-                    continue
-                points = []
-                data = {"id": int(track_id), "points": points}
-
-                self.results[track_id] = []
-                for track in gpx.tracks:
-                    print(f"Название трека: {track.name}")
-                    self.results[track_id].append(track.name)
-                    for segment in track.segments:
-                        segment_len = len(segment.points) - 1
-                        for index in range(len(segment.points)):
-                            point = segment.points[index]
-
-                            if index < segment_len:
-                                dlat = segment.points[index + 1].latitude - point.latitude
-                                dlng = segment.points[index + 1].longitude - point.longitude
-                            else:
-                                dlat = point.latitude - segment.points[index-1].latitude
-                                dlng = point.longitude - segment.points[index-1].longitude
-
-
-                            speed = segment.get_speed(index)
-                            if speed is None:
-                                continue
-                            angle = (atan2(dlng, dlat) * self.RAD_TO_GRAD) % 360
-                            dot = {
-                                "lat": point.latitude,
-                                "lng": point.longitude,
-                                "timestamp": str(point.time.strftime("%Y-%m-%d %H:%M:%S.%f")),
-                                "speed": speed,
-                                "angle": angle
-                            }
-                            points.append(dot)
-                if not points:
-                    self.moov_error_file(file=file)
-                    continue
-                yield json.dumps(data), file
+    @staticmethod
+    def prepare_file(file: str):
+        """
+        CPU-bound стадия, выполняется в пуле процессов: читает (и распаковывает) GPX
+        файл file из output/, разбирает его, считает скорость и направление в каждой
+        точке (векторно, см. gpx_points).
+        Возвращает (track, file, track_names, количество точек), track - словарь с id
+        трека и столбцами точек (columns, см. gpx_points.concat_columns), дерево gpxpy
+        и json в основной процесс не передаются. Если файл с ошибкой - он уже перенесён
+        в папку ошибок, а track равен None.
+        """
+        cls = UploadGpxFile
+        data = cls.read_file(file)
+        if data is None:
+            cls.moov_error_file(file)
+            return None, file, None, 0
+
+        track_id = file.split(".gpx")[0]
+        if not track_id.isdigit():
+            cls.moov_error_file(file)
+            return None, file, None, 0
+
+        try:
+            gpx = gpxpy.parse(data)
+        except Exception as exc:
+            print(exc)
+            traceback.print_exc()
+            # save_by_exception сама рассортирует различные ошибки по папкам.
+            save_by_exception(exc, cls.BASE_PATH, cls.ERROR_GPX_PATH, file)
+            return None, file, None, 0
+        columns = []
+        track_names = []
+        for track in gpx.tracks:
+            print(f"Название трека: {track.name}")
+            track_names.append(track.name)
+            for segment in track.segments:
+                columns.append(segment_columns(segment.points))
+        columns = concat_columns(columns)
+        points = len(columns["lat"])
+        if not points:
+            cls.moov_error_file(file=file)
+            return None, file, None, 0
+        return {"id": int(track_id), "columns": columns}, file, track_names, points
 
     def exit(self):
         """
@@ -193,14 +408,26 @@ class UploadGpxFile(BaseTask):
             Удалил временный файл.
             Распечатал результат работы.
         """
-        self.save(self.name_full_dict, self.results | self.results_for_search)
-        os.path.exists(self.name) and os.remove(self.name)
+        if self.store is None:
+            self.save(self.name_full_dict, self.results | self.results_for_search)
+            # Промежуточные файлы удаляются только когда полный снимок уже на диске.
+            wait_saved()
+            os.path.exists(self.name) and os.remove(self.name)
+        else:
+            self.save()
+        self.results.journal.remove()
+        self._scanner and self._scanner.close()
         print(f"Добавлено {self._count_points} новых записей.")
 
 
-tasks = [UploadGpxFile()]
+# Если задана переменная окружения STATE_DB - описания треков хранятся в SQLite базе с этим именем.
+store = StateStore(os.getenv("STATE_DB")) if os.getenv("STATE_DB") else None
+tasks = [UploadGpxFile(store=store)]
 
 
 if __name__ == "__main__":
-    atr = AsyncTaskRuner(chunk_size=int(os.getenv("CHUNK_SIZE", 10)), time_to_save=300)
+    atr = AsyncTaskRuner(
+        chunk_size=int(os.getenv("CHUNK_SIZE", 10)), time_to_save=300, workers=int(os.getenv("WORKERS", 0))
+    )
     atr.run(tasks)
+    store and store.close()
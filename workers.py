@@ -0,0 +1,374 @@
+"""
+Выполнение задач в нескольких процессах (AsyncTaskRuner(workers=N)).
+
+Основной процесс по-прежнему перебирает генераторы данных, каналы и лимиты,
+но сами задачи (task) выполняются в N процессах-исполнителях, у каждого свой
+event loop и свои aiohttp сессии. Исполнитель для очередной задачи выбирается
+наименее загруженный. CPU-bound стадия prepare остаётся в пуле процессов
+основного процесса (с тем же упреждением prefetch), исполнителю передаются уже
+подготовленные данные - иначе разбор блокировал бы все его задачи.
+
+Процессы-исполнители создаются через fork и получают копии объектов задач.
+Изменения, которые задача вносит в свои results и атрибуты из shared_state,
+записываются исполнителем и возвращаются вместе с результатом задачи, после
+чего повторяются над объектами основного процесса (журналы и сохранение
+работают как обычно). Контейнеры (set, dict, list) передают операции над
+собой, числовые атрибуты - приращение, остальные - новое значение. Контейнер
+вложенного объекта указывается через точку (например "fetcher.validators"). Счётчики
+в словарях нужно менять через increment (support.JournalDict.increment): у
+каждого исполнителя лишь часть изменений, поэтому передаётся приращение. Данные
+переданные задачей через put/append/emit ставятся в каналы основного процесса.
+Хранилище состояния задачи (атрибут store с методом reopen) исполнитель
+открывает заново - соединение SQLite нельзя использовать после fork. Ответы
+Задержка запросов исполнителей, ответы 429/5xx и таймауты передаются
+адаптивным лимитам основного процесса (AsyncTaskRuner(adaptive=True)), ошибки, обработанные
+задачей (BaseTask.error) - метрикам основного процесса.
+Исключение задачи передаётся в основной процесс (если оно сериализуется pickle)
+и вызывается там снова, например RetryTask ставит задачу в очередь повторов.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import signal
+import traceback
+
+from concurrency import limit_trace_config
+from metrics import error_type
+from ratelimit import HOST_LIMITS
+
+
+class WorkerError(Exception):
+    """Ошибка при выполнении задачи в процессе-исполнителе."""
+
+
+class RecordingSet(set):
+    def __init__(self, data, record):
+        super().__init__(data)
+        self.record = record
+
+    def add(self, item):
+        self.record("add", (item,))
+        super().add(item)
+
+    def discard(self, item):
+        self.record("discard", (item,))
+        super().discard(item)
+
+    def remove(self, item):
+        super().remove(item)
+        self.record("discard", (item,))
+
+
+class RecordingDict(dict):
+    def __init__(self, data, record):
+        super().__init__(data)
+        self.record = record
+
+    def __setitem__(self, key, value):
+        self.record("__setitem__", (key, value))
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.record("pop", (key, None))
+
+    def pop(self, key, *default):
+        self.record("pop", (key, None))
+        return super().pop(key, *default)
+
+    def increment(self, key, delta: int = 1):
+        # У исполнителя лишь его часть изменений - в основной процесс уходит приращение.
+        self.record("increment", (key, delta))
+        super().__setitem__(key, self.get(key, 0) + delta)
+
+
+class RecordingList(list):
+    def __init__(self, data, record):
+        super().__init__(data)
+        self.record = record
+
+    def append(self, item):
+        self.record("append", (item,))
+        super().append(item)
+
+    def extend(self, items):
+        items = list(items)
+        self.record("extend", (items,))
+        super().extend(items)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _Outbox:
+    """Изменения состояния задач и данные для каналов, накопленные исполнителем."""
+
+    def __init__(self):
+        self.ops = []  # (номер задачи, атрибут, операция, аргументы)
+        self.puts = []  # (номер задачи, данные)
+        self.overloads = []  # Номера задач, запросы которых получили 429/5xx или таймаут
+        self.latencies = []  # (номер задачи, задержка запроса)
+        self.errors = []  # (номер задачи, тип ошибки), обработанной задачей (BaseTask.error)
+
+    def take(self):
+        taken = self.ops, self.puts, self.overloads, self.latencies, self.errors
+        self.ops, self.puts, self.overloads, self.latencies, self.errors = [], [], [], [], []
+        return taken
+
+
+class _OutChannel:
+    """Канал задачи в процессе-исполнителе: данные отправляются в канал основного процесса."""
+
+    def __init__(self, outbox: _Outbox, index: int):
+        self.outbox = outbox
+        self.index = index
+
+    def __len__(self) -> int:
+        return 0
+
+    def full(self) -> bool:
+        return False
+
+    def put_nowait(self, item):
+        self.outbox.puts.append((self.index, item))
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+
+def _owner(task, name: str):
+    """Объект и имя атрибута для имени из shared_state, "fetcher.validators" - атрибут validators у task.fetcher."""
+    *path, attr = name.split(".")
+    owner = task
+    for part in path:
+        owner = getattr(owner, part)
+    return owner, attr
+
+
+def _record_state(task, index: int, outbox: _Outbox):
+    """Подменяет results и shared_state задачи так, чтобы все их изменения попадали в outbox."""
+    def recorder(name):
+        return lambda op, args: outbox.ops.append((index, name, op, args))
+
+    scalars = set()
+    for name in ("results", *task.shared_state):
+        owner, attr = _owner(task, name)
+        value = getattr(owner, attr)
+        if isinstance(value, (set, frozenset)):
+            setattr(owner, attr, RecordingSet(value, recorder(name)))
+        elif isinstance(value, dict):
+            setattr(owner, attr, RecordingDict(value, recorder(name)))
+        elif isinstance(value, list):
+            setattr(owner, attr, RecordingList(value, recorder(name)))
+        elif owner is task:
+            scalars.add(name)
+        else:
+            raise TypeError(f"{name}: через точку в shared_state можно указать только контейнер (set, dict, list).")
+    if not scalars:
+        return
+
+    cls = task.__class__
+
+    def __setattr__(self, name, value):
+        if name in scalars:
+            old = self.__dict__.get(name)
+            if _is_number(value) and _is_number(old):
+                outbox.ops.append((index, name, "+=", value - old))
+            else:
+                outbox.ops.append((index, name, "=", value))
+        cls.__setattr__(self, name, value)
+    task.__class__ = type(cls.__name__, (cls,), {"__setattr__": __setattr__})
+
+
+def apply_changes(tasks: list, ops: list):
+    """Повторяет изменения сделанные исполнителем над объектами задач основного процесса."""
+    for index, name, op, args in ops:
+        task = tasks[index]
+        if op == "=":
+            setattr(task, name, args)
+        elif op == "+=":
+            setattr(task, name, getattr(task, name) + args)
+        else:
+            owner, attr = _owner(task, name)
+            getattr(getattr(owner, attr), op)(*args)
+
+
+async def _serve(tasks: list, connection, limit: int, workers: int, adaptive: bool):
+    loop = asyncio.get_running_loop()
+    # Ограничения частоты запросов к хостам делятся между исполнителями поровну.
+    HOST_LIMITS.scale = 1 / workers
+    outbox = _Outbox()
+    for index, task in enumerate(tasks):
+        task.session = None
+        task.executor = None
+        task.dispatch = None
+        task._data = _OutChannel(outbox, index)
+        task.on_error = lambda exc, index=index: outbox.errors.append((index, error_type(exc)))
+        _record_state(task, index, outbox)
+        store = getattr(task, "store", None)
+        if store is not None and hasattr(store, "reopen"):
+            # Соединение с базой, унаследованное через fork, использовать нельзя.
+            store.reopen()
+    for index, task in enumerate(tasks):
+        trace_configs = None
+        if adaptive and task.use_session:
+            # Лимиты одновременных задач в основном процессе, туда и передаются задержки и сигналы о перегрузке.
+            trace_configs = [limit_trace_config(
+                lambda index=index: outbox.overloads.append(index),
+                lambda seconds, index=index: outbox.latencies.append((index, seconds)),
+            )]
+        await task.open_session(limit, trace_configs=trace_configs)
+
+    stop = asyncio.Event()
+    running = set()
+
+    async def run(request: int, index: int, data):
+        task = tasks[index]
+        try:
+            reply = (True, await task.task(data), None)
+        except Exception as exc:
+            # Тип исходного исключения для метрик: __cause__ через pickle не передаётся.
+            exc.error_type = error_type(exc)
+            reply = (False, exc, traceback.format_exc())
+        changes = outbox.take()
+        try:
+            connection.send((request, (*reply, *changes)))
+        except Exception:
+            # Результат или исключение задачи не удалось передать (например они не сериализуются pickle).
+            text = reply[2] or traceback.format_exc()
+            connection.send((request, (False, None, text, *changes)))
+
+    def receive():
+        try:
+            message = connection.recv()
+        except EOFError:
+            message = None
+        if message is None:
+            loop.remove_reader(connection.fileno())
+            stop.set()
+            return
+        job = loop.create_task(run(*message))
+        running.add(job)
+        job.add_done_callback(running.discard)
+
+    loop.add_reader(connection.fileno(), receive)
+    await stop.wait()
+    if running:
+        await asyncio.wait(running)
+    for task in tasks:
+        await task.close_session()
+
+
+def _worker_main(tasks: list, connection, limit: int, workers: int, adaptive: bool):
+    """Точка входа процесса-исполнителя."""
+    # Ctrl+C обрабатывает основной процесс, он же и остановит исполнителей.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_serve(tasks, connection, limit, workers, adaptive))
+    loop.close()
+    connection.close()
+
+
+class WorkerPool:
+    """
+    Процессы-исполнители задач.
+
+    tasks - список задач раннера (номер задачи в списке - её адрес для исполнителей).
+    workers - количество процессов.
+    limit - размер пула соединений сессий в каждом процессе.
+    adaptive - сообщать об ответах 429/5xx и таймаутах запросов исполнителей лимитам
+    одновременных задач (атрибут limits: задача -> concurrency.AdaptiveLimit).
+    Создавать до запуска event loop и до открытия сессий, сразу после создания задач.
+    """
+
+    def __init__(self, tasks: list, workers: int, limit: int, adaptive: bool = False):
+        context = multiprocessing.get_context("fork")
+        self.tasks = tasks
+        self.limits = {}
+        self._index = {task: index for index, task in enumerate(tasks)}
+        self._connections = []
+        self._processes = []
+        for _ in range(workers):
+            connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=_worker_main, args=(tasks, child_connection, limit, workers, adaptive), daemon=True,
+            )
+            process.start()
+            child_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+        self._load = [0] * workers
+        self._requests = itertools.count()
+        self._futures = {}  # номер запроса -> (future, номер исполнителя)
+
+    def start(self):
+        """Начинает принимать ответы исполнителей в текущем event loop."""
+        loop = asyncio.get_running_loop()
+        for number, connection in enumerate(self._connections):
+            loop.add_reader(connection.fileno(), self._receive, number)
+
+    def _receive(self, number: int):
+        connection = self._connections[number]
+        try:
+            request, reply = connection.recv()
+        except EOFError:
+            asyncio.get_running_loop().remove_reader(connection.fileno())
+            for future, worker in list(self._futures.values()):
+                if worker == number and not future.done():
+                    future.set_exception(WorkerError(f"Процесс-исполнитель {number} завершился."))
+            return
+        future, _ = self._futures.pop(request)
+        if not future.done():
+            future.set_result(reply)
+
+    async def run(self, task, data):
+        """Выполняет задачу с данными data в наименее загруженном исполнителе."""
+        number = min(range(len(self._load)), key=self._load.__getitem__)
+        request = next(self._requests)
+        future = asyncio.get_running_loop().create_future()
+        self._futures[request] = (future, number)
+        self._load[number] += 1
+        try:
+            self._connections[number].send((request, self._index[task], data))
+            ok, result, text, ops, puts, overloads, latencies, errors = await future
+        finally:
+            self._load[number] -= 1
+            self._futures.pop(request, None)
+        apply_changes(self.tasks, ops)
+        for index in overloads:
+            limit = self.limits.get(self.tasks[index])
+            if limit is not None:
+                limit.on_error()
+        for index, seconds in latencies:
+            limit = self.limits.get(self.tasks[index])
+            if limit is not None:
+                limit.on_latency(seconds)
+        for index, error in errors:
+            self.tasks[index].error(error)
+        for index, item in puts:
+            await self.tasks[index].put(item)
+        if not ok:
+            if result is None:
+                raise WorkerError(text)
+            raise result from WorkerError(text)
+        return result
+
+    def close(self):
+        """Останавливает исполнителей после завершения их задач."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        for connection in self._connections:
+            if loop is not None:
+                loop.remove_reader(connection.fileno())
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join()
+        for connection in self._connections:
+            connection.close()